@@ -21,12 +21,14 @@ import cv2
 import gc
 import numpy as np
 import pandas as pd
+import time
 import itertools
 from tqdm.autonotebook import tqdm
 import albumentations as A
 import matplotlib.pyplot as plt
 
 import torch
+import torch.utils.checkpoint
 from torch import nn
 import torch.nn.functional as F
 import timm
@@ -102,6 +104,10 @@ class CFG:
 
     pretrained = True # for both image encoder and text encoder
     trainable = True # for both image encoder and text encoder
+    # recompute the activations of the EfficientNet blocks / MPNet layers in the backward
+    # instead of keeping them (less memory, about one extra forward pass per tower)
+    image_grad_checkpointing = False
+    text_grad_checkpointing = False
     temperature = 1.0
 
     # image size
@@ -198,7 +204,8 @@ class ImageEncoder(nn.Module):
     """
 
     def __init__(
-        self, model_name=CFG.model_name, pretrained=CFG.pretrained, trainable=CFG.trainable
+        self, model_name=CFG.model_name, pretrained=CFG.pretrained, trainable=CFG.trainable,
+        grad_checkpointing=CFG.image_grad_checkpointing,
     ):
         super().__init__()
 
@@ -211,10 +218,26 @@ class ImageEncoder(nn.Module):
 
         for p in self.model.parameters():
             p.requires_grad = trainable
+        self.set_grad_checkpointing(grad_checkpointing)
+
+    def set_grad_checkpointing(self, enable=True):
+        # efficientnet_pytorch has no checkpointing of its own, so the forward of every
+        # MBConv block is wrapped on the instance (the parameter names stay the same)
+        for block in self.model._blocks:
+            if enable:
+                block.forward = checkpointed(type(block).forward.__get__(block))
+            else:
+                block.__dict__.pop("forward", None)
 
     def forward(self, x):
         return self.model(x)
 
+
+def checkpointed(forward):
+    def checkpointed_forward(*args, **kwargs):
+        return torch.utils.checkpoint.checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return checkpointed_forward
+
 """## Text Encoder"""
 
 class TextEncoder(nn.Module):
@@ -240,7 +263,10 @@ class TextEncoder(nn.Module):
 from transformers import AutoModel, AutoConfig
 
 class TextEncoder(nn.Module):
-    def __init__(self, model_name=CFG.text_encoder_model, pretrained=CFG.pretrained, trainable=CFG.trainable):
+    def __init__(
+        self, model_name=CFG.text_encoder_model, pretrained=CFG.pretrained, trainable=CFG.trainable,
+        grad_checkpointing=CFG.text_grad_checkpointing,
+    ):
         super().__init__()
 
         if pretrained:
@@ -253,10 +279,20 @@ class TextEncoder(nn.Module):
 
         for p in self.model.parameters():
             p.requires_grad = trainable
+        self.set_grad_checkpointing(grad_checkpointing)
 
         # We are using the CLS token hidden representation as the sentence's embedding
         self.target_token_idx = 0
 
+    def set_grad_checkpointing(self, enable=True):
+        # MPNetPreTrainedModel does not support HuggingFace's gradient_checkpointing_enable,
+        # so the forward of every MPNet layer is wrapped like the image stages
+        for layer in self.model.encoder.layer:
+            if enable:
+                layer.forward = checkpointed(type(layer).forward.__get__(layer))
+            else:
+                layer.__dict__.pop("forward", None)
+
     def forward(self, input_ids, attention_mask):
         output = self.model(input_ids=input_ids, attention_mask=attention_mask)
         last_hidden_state = output.last_hidden_state
@@ -337,6 +373,69 @@ def cross_entropy(preds, targets, reduction='none'):
     elif reduction == "mean":
         return loss.mean()
 
+"""### Gradient Checkpointing
+
+MPNet has 12 layers and EfficientNet-B0 16 MBConv blocks, and the activations that are kept for the backward pass are what limits the batch size. With `CFG.image_grad_checkpointing` / `CFG.text_grad_checkpointing` a tower only keeps the inputs of every EfficientNet block / MPNet layer and recomputes the rest during the backward: much less memory, for roughly one extra forward pass of that tower. The parameter names do not change, so checkpoints load either way.
+
+`benchmark_grad_checkpointing` trains a few steps on a dummy batch with each combination and reports the time per step and the activation memory (the CUDA peak on a GPU; on CPU the bytes of the tensors autograd keeps for the backward).
+"""
+
+def benchmark_grad_checkpointing(batch_size=CFG.batch_size, length=64, steps=3):
+    model = CLIPModel().to(CFG.device)
+    model.train()
+    batch = {
+        "image": torch.zeros((batch_size, 3, CFG.size, CFG.size), device=CFG.device),
+        "input_ids": torch.zeros((batch_size, length), dtype=torch.long, device=CFG.device),
+        "attention_mask": torch.ones((batch_size, length), dtype=torch.long, device=CFG.device),
+    }
+    parameter_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def train_step():
+        saved = {}
+
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in parameter_storages:
+                saved[storage.data_ptr()] = storage.nbytes()
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            loss = model(batch)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        return sum(saved.values())
+
+    results = []
+    for image_checkpointing, text_checkpointing in itertools.product([False, True], repeat=2):
+        model.image_encoder.set_grad_checkpointing(image_checkpointing)
+        model.text_encoder.set_grad_checkpointing(text_checkpointing)
+        train_step() # warm-up
+        if CFG.device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            # weights and the batch are already allocated; the rest of the peak is the step
+            allocated = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        for _ in range(steps):
+            saved_bytes = train_step()
+        if CFG.device.type == "cuda":
+            torch.cuda.synchronize()
+            saved_bytes = torch.cuda.max_memory_allocated() - allocated
+        results.append({
+            "image_checkpointing": image_checkpointing,
+            "text_checkpointing": text_checkpointing,
+            "ms_per_step": (time.perf_counter() - start) / steps * 1000,
+            "activation_mb": saved_bytes / 2 ** 20,
+        })
+    results = pd.DataFrame(results)
+    baseline = results.iloc[0]
+    results["time_vs_baseline"] = results["ms_per_step"] / baseline["ms_per_step"]
+    results["memory_vs_baseline"] = results["activation_mb"] / baseline["activation_mb"]
+    print(results.to_string(index=False))
+    return results
+
+# benchmark_grad_checkpointing()
+
 """## Train"""
 
 def make_train_valid_dfs():
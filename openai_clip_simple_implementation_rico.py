@@ -15,16 +15,33 @@ Given a query (raw text) like "pop-up message showing about free access	" or "a
 !pip install transformers
 
 import os
+import io
+import re
+import random
+import struct
+import tarfile
+import zlib
+import zipfile
 import cv2
 import gc
+import json
+import hashlib
+import time
+import threading
+import contextlib
 import numpy as np
 import pandas as pd
 import itertools
+import functools
 from tqdm.autonotebook import tqdm
 import albumentations as A
 import matplotlib.pyplot as plt
+from PIL import Image
 
 import torch
+import torch.distributed as dist
+import torch.distributed.nn
+import torch.utils.checkpoint
 from torch import nn
 import torch.nn.functional as F
 import timm
@@ -106,6 +123,10 @@ class CFG:
     factor = 0.8
     epochs = 4
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # mixed precision: autocast the encoders to amp_dtype (bfloat16 works on CPU and GPU;
+    # float16 is GPU only and turns on the GradScaler)
+    amp = False
+    amp_dtype = torch.bfloat16
 
     model_name = 'resnet50'
     image_embedding = 2048
@@ -113,13 +134,77 @@ class CFG:
     text_embedding = 768
     text_tokenizer = "distilbert-base-uncased"
     max_length = 200
+    # group captions of similar token length into the same training batch
+    bucket_by_length = False
+    bucket_size = 100 # number of batches in each length-sorted pool
+    # never put two rows with the same unique_batch_key ("image" or "activity_name") in one batch
+    unique_batches = False
+    unique_batch_key = "image"
+    # leftover unique batches smaller than this are dropped (their rows skip that epoch)
+    unique_min_batch_size = 16
+    # folder for the pre-tokenized caption store; None tokenizes in CLIPDataset.__init__
+    token_cache_path = None
 
     pretrained = True # for both image encoder and text encoder
     trainable = True # for both image encoder and text encoder
+    # recompute the activations of the ResNet stages / transformer layers in the backward
+    # instead of keeping them, see benchmark_grad_checkpointing
+    image_grad_checkpointing = False
+    text_grad_checkpointing = False
+    # LoRA: freeze both backbones and train low-rank adapters on the layers below (see add_lora)
+    lora = False
+    lora_rank = 8
+    lora_alpha = 16
+    lora_lr = 5e-4
+    lora_text_targets = ("q_lin", "v_lin") # attention projections of DistilBERT; ("q", "v") for MPNet
+    lora_image_targets = ("layer4",) # the convs of these ResNet stages
+    # with trainable = False: run the encoders once and train the projection heads on cached features
+    cache_frozen_features = False
+    feature_cache_path = "/content/feature_cache"
     temperature = 1.0
+    # "soft": targets from the image and text similarities (handles repeated images);
+    # "identity": plain arange targets, only correct together with unique_batches;
+    # "image_id": every row with the same image is a positive (from the image ids of the batch)
+    loss_targets = "soft"
+    # compute the contrastive loss this many rows at a time (see ChunkedContrastiveLoss);
+    # None builds the full batch_size x batch_size matrices
+    loss_chunk_size = None
+    # gradient caching: with a large batch_size, run the encoders this many samples at a
+    # time and still compute the loss over the whole batch (see grad_cache_step)
+    grad_cache_sub_batch_size = None
+    # keep the image/text embeddings of this many recent samples as extra negatives (0 = off)
+    queue_size = 0
 
     # image size
     size = 224
+    # "cv2" (full decode), "cv2_reduced" or "pil_draft" (scaled jpeg decode), see read_image
+    decode_backend = "cv2"
+    # zip files to read the screenshots from (e.g. ["/content/drive/MyDrive/trainImages.zip"]);
+    # None reads them from image_path
+    image_archives = None
+    # folder for the tar shards of every split (see write_shards); None reads the jpgs through CLIPDataset
+    shard_path = None
+    images_per_shard = 1000
+    # captions held in the shuffle buffer of ShardedCLIPDataset
+    shuffle_buffer = 1000
+    # folder written by build_image_cache; None decodes the jpgs on every fetch
+    image_cache_path = None
+    # workers send uint8 images and ImageEncoder normalizes the whole batch
+    normalize_on_device = False
+    # folder for the resumable full-state checkpoint (last.pt); None only saves best.pt
+    checkpoint_path = None
+    checkpoint_every = 200 # train steps between two checkpoints
+    # copy the running losses to the host (and update the progress bar) every log_every steps
+    log_every = 50
+    # torch.compile the encoders and projection heads (see compile_model)
+    compile = False
+    compile_mode = "default" # or "reduce-overhead", "max-autotune"
+    # pad every batch of captions to a multiple of this many tokens, so the compiled text
+    # encoder only sees a few sequence lengths; None pads to the longest caption
+    pad_to_multiple_of = None
+    # inductor's compiled-graph cache survives between runs in this folder
+    compile_cache_path = "/content/inductor_cache"
+    seed = 42 # the order of every epoch only depends on (seed, epoch)
 
     # for projection head; used for both image and text encoders
     num_projection_layers = 1
@@ -145,17 +230,69 @@ class AvgMeter:
         text = f"{self.name}: {self.avg:.4f}"
         return text
 
+class DeviceAvgMeter(AvgMeter):
+    """
+    AvgMeter for loss tensors: update() adds to a running sum that stays on the
+    device, so it never waits for the step to finish. sum and avg are only up to
+    date after sync(), which copies the sum to the host.
+    """
+
+    def reset(self):
+        super().reset()
+        self.device_sum = None
+        self.pending_count = 0
+
+    def update(self, val, count=1):
+        if self.device_sum is None:
+            self.device_sum = torch.zeros((), device=val.device)
+        self.device_sum.add_(val.detach().float(), alpha=count)
+        self.pending_count += count
+
+    def sync(self):
+        if self.device_sum is not None:
+            self.sum += self.device_sum.item()
+            self.device_sum.zero_()
+        self.count += self.pending_count
+        self.pending_count = 0
+        self.avg = self.sum / self.count if self.count else 0
+        return self
+
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
         return param_group["lr"]
 
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+@contextlib.contextmanager
+def main_process_first():
+    # rank 0 runs the block first and writes the caches (split manifest, token store,
+    # feature cache); the other ranks wait for it and then only read them
+    if is_distributed() and not is_main_process():
+        dist.barrier()
+    yield
+    if is_distributed() and is_main_process():
+        dist.barrier()
+
+def amp_autocast():
+    return torch.autocast(device_type=CFG.device.type, dtype=CFG.amp_dtype, enabled=CFG.amp)
+
+def unique_images(dataframe):
+    # keeps the first row of every image, in order of first appearance (same as .unique())
+    return dataframe.drop_duplicates(subset="image").reset_index(drop=True)
+
 """## Dataset
 
 As you can see in the tittle image of this article, we need to encode both images and their describing texts. So, the dataset needs to **return both images and texts**. Of course we are not going to feed raw text to our text encoder! We will use **DistilBERT** model (which is smaller than BERT but performs nearly as well as BERT) from **HuggingFace** library as our text encoder; so, we need to **tokenize** the sentences (captions) with DistilBERT tokenizer and then feed the token ids (input_ids) and the attention masks to DistilBERT. Therefore, the dataset needs to take care of the tokenization as well. Below you can see the dataset's code. Below that I'll explain the most important things that is happening in the code.
 
-In the **\_\_init\_\_** we receive a tokenizer object which is actually a HuggingFace tokinzer; this tokenizer will be loaded when running the model. We are padding and truncating the captions to a specified max_length. In the **\_\_getitem\_\_** we will first load an encoded caption which is a dictionary with keys input_ids and attention_mask, make tensors out of its values and after that we will load the corresponding image, transform and augment it (if there is any!) and then we make it a tensor and put it in the dictionary with "image" as the key. Finally we put the raw text of the caption with the key "caption" in the dictionary only for visualization purposes.
+In the **\_\_init\_\_** we receive a tokenizer object which is actually a HuggingFace tokinzer; this tokenizer will be loaded when running the model. We are truncating the captions to a specified max_length, but we do not pad them here: padding every caption to the longest caption of the whole dataset makes the text encoder pay for that one outlier in every batch. Instead, `collate_captions` pads each batch only up to its own longest caption. In the **\_\_getitem\_\_** we will first slice the token ids of the caption out of one flat array, make the input_ids and attention_mask tensors out of them and after that we will load the corresponding image, transform and augment it (if there is any!) and then we make it a tensor and put it in the dictionary with "image" as the key. Finally we put the raw text of the caption with the key "caption" in the dictionary only for visualization purposes.
 
 I did not use additional data augmentations but you can add them if you want to improve the model's performance.
+
+A note on memory: the dataset keeps the file names and captions as fixed-width numpy string arrays and all the token ids in one flat int32 array with offsets (caption `i` is `input_ids[token_offsets[i]:token_offsets[i + 1]]`). With python lists, every DataLoader worker touches the refcount of each object it reads, and those pages slowly get copied into every forked worker; with numpy arrays the worker memory stays flat and reading an item is just a slice.
 """
 
 class CLIPDataset(torch.utils.data.Dataset):
@@ -166,24 +303,47 @@ class CLIPDataset(torch.utils.data.Dataset):
         file names
         """
 
-        self.image_filenames = image_filenames
-        self.captions = list(captions)
-        self.encoded_captions = tokenizer(
-            list(captions), padding=True, truncation=True, max_length=CFG.max_length
-        )
+        # flat numpy arrays instead of python lists: forked workers never touch
+        # per-element refcounts, so these pages stay shared with the main process
+        self.image_filenames = np.asarray(image_filenames, dtype=np.str_)
+        self.captions = np.asarray([str(caption) for caption in captions], dtype=np.str_)
+        # rows with the same image file get the same id, for the "image_id" loss targets
+        self.image_ids = pd.factorize(self.image_filenames)[0]
+        if CFG.token_cache_path is not None:
+            self.input_ids, self.token_offsets, self.token_rows = load_token_store(
+                captions, tokenizer, CFG.token_cache_path
+            )
+        else:
+            encoded_captions = tokenizer(
+                list(captions), padding=False, truncation=True, max_length=CFG.max_length
+            )
+            self.input_ids, self.token_offsets = flatten_token_ids(encoded_captions["input_ids"])
+            self.token_rows = np.arange(len(self.captions))
+        self.caption_lengths = np.diff(self.token_offsets)[self.token_rows]
         self.transforms = transforms
+        self.image_cache = None
+        if CFG.image_cache_path is not None:
+            self.image_cache, cache_index = load_image_cache(
+                CFG.image_cache_path, self.image_filenames
+            )
+            self.image_rows = np.array(
+                [cache_index[image_filename] for image_filename in image_filenames]
+            )
 
     def __getitem__(self, idx):
-        item = {
-            key: torch.tensor(values[idx])
-            for key, values in self.encoded_captions.items()
-        }
-
-        image = cv2.imread(f"{CFG.image_path}/{self.image_filenames[idx]}")
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = self.transforms(image=image)['image']
-        item['image'] = torch.tensor(image).permute(2, 0, 1).float()
-        item['caption'] = self.captions[idx]
+        row = self.token_rows[idx]
+        input_ids = self.input_ids[self.token_offsets[row]:self.token_offsets[row + 1]]
+        input_ids = torch.from_numpy(input_ids.astype(np.int64))
+        item = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+        if self.image_cache is not None:
+            # already decoded, RGB and resized to CFG.size
+            image = np.array(self.image_cache[self.image_rows[idx]])
+        else:
+            image = load_image(self.image_filenames[idx])
+        item['image'] = image_to_tensor(image, self.transforms)
+        item['caption'] = str(self.captions[idx])
+        item['image_id'] = int(self.image_ids[idx])
 
         return item
 
@@ -192,28 +352,516 @@ class CLIPDataset(torch.utils.data.Dataset):
         return len(self.captions)
 
 
+def flatten_token_ids(token_ids):
+    """
+    packs a list of token id lists into one int32 array plus offsets, so that
+    token_ids[i] == input_ids[offsets[i]:offsets[i + 1]]
+    """
+    lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+    input_ids = np.fromiter(
+        itertools.chain.from_iterable(token_ids), dtype=np.int32, count=lengths.sum()
+    )
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return input_ids, offsets
+
+
+def image_to_tensor(image, transforms):
+    image = transforms(image=image)['image']
+    if CFG.normalize_on_device:
+        return torch.from_numpy(image).permute(2, 0, 1).contiguous()
+    return torch.tensor(image).permute(2, 0, 1).float()
+
+
+def collate_captions(items, pad_token_id=0, pad_to_multiple_of=None):
+    """
+    pads input_ids and attention_mask to the longest caption of this batch
+    (rounded up to pad_to_multiple_of); everything else (image, caption, ...)
+    goes through the default collate
+    """
+    max_length = max(len(item["input_ids"]) for item in items)
+    if pad_to_multiple_of:
+        max_length = -(-max_length // pad_to_multiple_of) * pad_to_multiple_of
+    batch = {
+        "input_ids": torch.full((len(items), max_length), pad_token_id, dtype=torch.long),
+        "attention_mask": torch.zeros((len(items), max_length), dtype=torch.long),
+    }
+    for row, item in enumerate(items):
+        length = len(item["input_ids"])
+        batch["input_ids"][row, :length] = item["input_ids"]
+        batch["attention_mask"][row, :length] = item["attention_mask"]
+    for key in items[0]:
+        if key not in batch:
+            batch[key] = torch.utils.data.default_collate([item[key] for item in items])
+    return batch
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Shuffles the dataset, cuts it into pools of bucket_size batches, sorts every
+    pool by caption length and splits it into batches; the batches are shuffled
+    again so the model does not see the lengths in order. Batches then hold
+    captions of similar length and dynamic padding has almost nothing to pad.
+    """
+
+    def __init__(
+        self, lengths, batch_size, bucket_size=100, shuffle=True, drop_last=False, seed=42,
+        num_replicas=1, rank=0,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        # every rank draws the same batches from the same seed and keeps every num_replicas-th one
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        self.rng = np.random.default_rng([self.seed, epoch])
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = self.rng.permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            batches.extend(
+                pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)
+            )
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        # every pool but the last one splits into exactly bucket_size batches
+        full_pools, rest = divmod(len(self.lengths), self.batch_size * self.bucket_size)
+        if self.drop_last:
+            n_batches = full_pools * self.bucket_size + rest // self.batch_size
+        else:
+            n_batches = full_pools * self.bucket_size + -(-rest // self.batch_size)
+        return n_batches // self.num_replicas
+
+
+class UniqueKeyBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches in which no two rows share a key (the image file or the app). The
+    rows are visited in random order and each one goes into the first open batch
+    that does not hold its key yet; a batch is emitted as soon as it is full.
+    The batches still open at the end are kept only if they hold at least
+    min_batch_size rows: a key with many rows (the "android" app has 1,010)
+    leaves hundreds of 1-row batches behind, whose loss is 0 while the
+    optimizer still steps. With several ranks the batches are num_replicas times larger and every rank
+    takes its own slice, so the gathered global batch is unique as well.
+    """
+
+    def __init__(
+        self, keys, batch_size, shuffle=True, drop_last=False, min_batch_size=1, seed=42,
+        num_replicas=1, rank=0,
+    ):
+        self.keys = pd.factorize(np.asarray(keys))[0]
+        self.batch_size = batch_size
+        self.min_batch_size = min(max(min_batch_size, 1), batch_size)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.rng = np.random.default_rng([self.seed, epoch])
+        self._batches = None
+
+    def _plan(self):
+        if self.shuffle:
+            indices = self.rng.permutation(len(self.keys))
+        else:
+            indices = np.arange(len(self.keys))
+        global_batch_size = self.batch_size * self.num_replicas
+        batches = []
+        pending = [] # (rows, keys) of the batches that are not full yet
+        for index in indices.tolist():
+            key = self.keys[index]
+            for slot, (rows, keys) in enumerate(pending):
+                if key not in keys:
+                    break
+            else:
+                slot, rows, keys = len(pending), [], set()
+                pending.append((rows, keys))
+            rows.append(index)
+            keys.add(key)
+            if len(rows) == global_batch_size:
+                batches.append(rows)
+                del pending[slot]
+        if not self.drop_last:
+            # the leftovers are smaller but still unique
+            min_rows = self.min_batch_size * self.num_replicas
+            batches.extend(rows for rows, keys in pending if len(rows) >= min_rows)
+        return batches
+
+    def __iter__(self):
+        # __len__ has to plan the epoch first, so it keeps the plan for the next __iter__
+        batches = self._batches if self._batches is not None else self._plan()
+        self._batches = None
+        for batch in batches:
+            yield batch[self.rank::self.num_replicas]
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self._plan()
+        return len(self._batches)
+
 
 def get_transforms(mode="train"):
+    # with normalize_on_device the images stay uint8 and ImageEncoder normalizes them
+    if CFG.normalize_on_device:
+        normalize = []
+    else:
+        normalize = [A.Normalize(max_pixel_value=255.0, always_apply=True)]
     if mode == "train":
         return A.Compose(
             [
                 A.Resize(CFG.size, CFG.size, always_apply=True),
-                A.Normalize(max_pixel_value=255.0, always_apply=True),
+                *normalize,
             ]
         )
     else:
         return A.Compose(
             [
                 A.Resize(CFG.size, CFG.size, always_apply=True),
-                A.Normalize(max_pixel_value=255.0, always_apply=True),
+                *normalize,
             ]
         )
 
+"""## Image Decoding
+
+Rico screenshots are about 1080x1920 and we throw most of those pixels away right after decoding, when we resize them to 224x224. JPEG can do better: libjpeg(-turbo) can decode an image directly at 1/2, 1/4 or 1/8 of its size in the DCT domain, which skips most of the decoding work. `read_image` supports three backends:
+
+- `"cv2"`: the full-size `cv2.imread` we used so far
+- `"cv2_reduced"`: `cv2.imread` with one of the `IMREAD_REDUCED_COLOR_*` flags
+- `"pil_draft"`: PIL with `draft` mode, which picks the scale itself
+
+For `"cv2_reduced"` we read the image size from the file header and pick the largest reduction factor that still leaves both sides at least `CFG.size` pixels, so the resize to `CFG.size` never has to upscale. The decoded pixels are not bit-identical to the full decode followed by a resize, so rebuild the image cache if you switch backends.
+"""
+
+_CV2_REDUCED_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def reduction_factor(width, height, size=CFG.size):
+    for factor in (8, 4, 2):
+        if min(width, height) // factor >= size:
+            return factor
+    return 1
+
+
+def read_image(path, backend=None, size=CFG.size):
+    """
+    returns the image at path as an RGB uint8 array; the reduced backends
+    return it smaller than the file, but never smaller than size x size
+    """
+    backend = backend or CFG.decode_backend
+    if backend == "cv2":
+        image = cv2.imread(path)
+    elif backend == "cv2_reduced":
+        with Image.open(path) as header:
+            factor = reduction_factor(*header.size, size=size)
+        image = cv2.imread(path, _CV2_REDUCED_FLAGS.get(factor, cv2.IMREAD_COLOR))
+    elif backend == "pil_draft":
+        with Image.open(path) as image:
+            image.draft("RGB", (size, size))
+            return np.asarray(image.convert("RGB"))
+    else:
+        raise ValueError(f"unknown decode backend: {backend}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def decode_image(data, backend=None, size=CFG.size):
+    """
+    same as read_image, for the encoded bytes of an image instead of its path
+    """
+    backend = backend or CFG.decode_backend
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if backend == "cv2":
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    elif backend == "cv2_reduced":
+        with Image.open(io.BytesIO(data)) as header:
+            factor = reduction_factor(*header.size, size=size)
+        image = cv2.imdecode(buffer, _CV2_REDUCED_FLAGS.get(factor, cv2.IMREAD_COLOR))
+    elif backend == "pil_draft":
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft("RGB", (size, size))
+            return np.asarray(image.convert("RGB"))
+    else:
+        raise ValueError(f"unknown decode backend: {backend}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+"""A small benchmark to pick the backend: it decodes (and resizes to `CFG.size`) the same screenshots with each backend and prints the throughput. The files (or the members of `CFG.image_archives`) are read into memory before timing, so only the decoding is measured and the first backend does not pay for the cold disk cache. It takes a while, so the call is commented out."""
+
+def benchmark_decode_backends(image_path=CFG.image_path, n_images=500, backends=("cv2", "cv2_reduced", "pil_draft")):
+    # the jpgs are read into memory first, so only the decoding is timed
+    if CFG.image_archives:
+        image_filenames = sorted(open_image_archives(tuple(CFG.image_archives)).members)[:n_images]
+    else:
+        image_filenames = sorted(os.listdir(image_path))[:n_images]
+    images = [read_image_bytes(image_filename, image_path) for image_filename in image_filenames]
+
+    throughput = {}
+    for backend in backends:
+        start = time.perf_counter()
+        for data in images:
+            image = decode_image(data, backend=backend)
+            cv2.resize(image, (CFG.size, CFG.size), interpolation=cv2.INTER_LINEAR)
+        throughput[backend] = len(images) / (time.perf_counter() - start)
+        print(f"{backend}: {throughput[backend]:.1f} images/s")
+    return throughput
+
+# benchmark_decode_backends()
+
+"""## Reading Images from the Zip Archives
+
+Unzipping `trainImages.zip`, `testImages.zip` and `validImages.zip` (and moving the test images around with `shutil.move`) at the start of the notebook takes minutes and doubles the disk usage. We don't really need the extracted files: a zip file has a central directory at its end that tells us where every member starts, so we can read any screenshot straight from the archive.
+
+`ZipImageSource` reads the central directory of each archive once and keeps a file name -> member index. To read an image it seeks to the member's local header, skips it and reads the (stored or deflated) bytes. Every process opens its own file handles, because forked DataLoader workers must not share a file offset. Set `CFG.image_archives` to the list of zip files and `CLIPDataset`, the image cache and `find_matches` read from them; the `!unzip` cells above can then be skipped.
+"""
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+class ZipImageSource:
+    """
+    Random-access reads of the images inside zip archives, without extracting them
+    """
+
+    def __init__(self, archive_paths):
+        self.archive_paths = list(archive_paths)
+        self.members = {}
+        for archive_id, archive_path in enumerate(self.archive_paths):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                        self.members[os.path.basename(info.filename)] = (
+                            archive_id,
+                            info.header_offset,
+                            info.compress_size,
+                            info.compress_type,
+                        )
+        self._pid = None
+        self._files = None
+
+    def _open_files(self):
+        if self._pid != os.getpid():
+            self._files = [open(archive_path, "rb") for archive_path in self.archive_paths]
+            self._pid = os.getpid()
+        return self._files
+
+    def read(self, image_filename):
+        archive_id, header_offset, compress_size, compress_type = self.members[image_filename]
+        f = self._open_files()[archive_id]
+        # local file header: 30 fixed bytes, then the file name and the extra field
+        f.seek(header_offset)
+        name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+        data = f.read(compress_size)
+        if compress_type == zipfile.ZIP_STORED:
+            return data
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+        raise ValueError(f"{image_filename}: unsupported zip compression {compress_type}")
+
+    def __contains__(self, image_filename):
+        return image_filename in self.members
+
+    def __getstate__(self):
+        # file handles are opened again in the process that unpickles us
+        state = self.__dict__.copy()
+        state["_pid"], state["_files"] = None, None
+        return state
+
+
+@functools.lru_cache(maxsize=None)
+def open_image_archives(archive_paths):
+    return ZipImageSource(archive_paths)
+
+
+def load_image(image_filename, image_path=None, backend=None):
+    if CFG.image_archives:
+        return decode_image(read_image_bytes(image_filename), backend=backend)
+    return read_image(f"{image_path or CFG.image_path}/{image_filename}", backend=backend)
+
+
+def read_image_bytes(image_filename, image_path=None):
+    if CFG.image_archives:
+        return open_image_archives(tuple(CFG.image_archives)).read(image_filename)
+    with open(f"{image_path or CFG.image_path}/{image_filename}", "rb") as f:
+        return f.read()
+
+"""## Image Cache
+
+Profiling the training loop showed that the DataLoader workers, not the ResNet50, were the bottleneck: every time a caption row is fetched, `__getitem__` decodes a full-size Rico screenshot and resizes it, in every epoch (and each screenshot has about 5 captions!). So here is a one-time build step: we decode every image under `CFG.image_path` once, resize it to `CFG.size` and pack all of them into a single memory-mapped uint8 array with shape (N, size, size, 3), plus a small csv that maps each file name to its row in the array.
+
+When `CFG.image_cache_path` points to that folder, `CLIPDataset` just slices the image out of the array, so an epoch does not decode a single jpg. The resize uses the same interpolation as `A.Resize`, so the model sees the same pixels as before.
+
+The file names hold the size and a hash of where the images come from (`CFG.image_path` or `CFG.image_archives`, and `CFG.decode_backend`), so changing any of them builds a new cache instead of reading the old one. The folder can also change under the same path (the test cell below moves the test images into `trainImages`). So `load_image_cache` checks that every file of the dataframe is in the index, and builds the cache again if one is missing.
+"""
+
+def image_cache_name(image_path=CFG.image_path, size=CFG.size):
+    if CFG.image_archives:
+        source = {"image_archives": sorted(os.path.abspath(path) for path in CFG.image_archives)}
+    else:
+        source = {"image_path": os.path.abspath(image_path)}
+    source["decode_backend"] = CFG.decode_backend
+    source_hash = hashlib.sha1(json.dumps(source, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return f"{size}-{source_hash}"
+
+
+def build_image_cache(cache_path, image_path=CFG.image_path, size=CFG.size):
+    if CFG.image_archives:
+        image_filenames = sorted(open_image_archives(tuple(CFG.image_archives)).members)
+    else:
+        image_filenames = sorted(
+            image_filename for image_filename in os.listdir(image_path)
+            if image_filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+    os.makedirs(cache_path, exist_ok=True)
+    cache_name = image_cache_name(image_path, size)
+    images = np.lib.format.open_memmap(
+        f"{cache_path}/images_{cache_name}.npy",
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(image_filenames), size, size, 3),
+    )
+    for row, image_filename in enumerate(tqdm(image_filenames)):
+        image = load_image(image_filename, image_path=image_path)
+        images[row] = cv2.resize(image, (size, size), interpolation=cv2.INTER_LINEAR)
+    images.flush()
+    # the index is written last, so a cache without one is an unfinished build
+    pd.DataFrame({"image": image_filenames}).to_csv(
+        f"{cache_path}/index_{cache_name}.csv.tmp", index=False
+    )
+    os.replace(f"{cache_path}/index_{cache_name}.csv.tmp", f"{cache_path}/index_{cache_name}.csv")
+    return images
+
+
+def _read_image_cache_index(index_path):
+    if not os.path.exists(index_path):
+        return {}
+    image_filenames = pd.read_csv(index_path)["image"]
+    return {image_filename: row for row, image_filename in enumerate(image_filenames)}
+
+
+def load_image_cache(cache_path, image_filenames=(), image_path=CFG.image_path, size=CFG.size):
+    """
+    returns the cached images and a file name -> row dict; builds the cache
+    again if it is missing or lacks one of image_filenames
+    """
+    cache_name = image_cache_name(image_path, size)
+    index_path = f"{cache_path}/index_{cache_name}.csv"
+    cache_index = _read_image_cache_index(index_path)
+    if not cache_index or any(image_filename not in cache_index for image_filename in image_filenames):
+        build_image_cache(cache_path, image_path, size)
+        cache_index = _read_image_cache_index(index_path)
+    images = np.load(f"{cache_path}/images_{cache_name}.npy", mmap_mode="r")
+    return images, cache_index
+
+"""Building the cache takes a few minutes, but only once; the next runs reuse the files."""
+
+if CFG.image_cache_path is not None and not os.path.exists(
+    f"{CFG.image_cache_path}/index_{image_cache_name()}.csv"
+):
+    build_image_cache(CFG.image_cache_path)
+
+"""## Token Store
+
+Tokenizing the whole caption column with the (slow, pure python) tokenizer is what makes the start of every run take a while. The token store keeps the tokenized captions on disk, so we only pay for it once: all the token ids live in one flat int32 array (`input_ids.npy`) and `offsets.npy` says where each caption starts and ends, so caption `r` is `input_ids[offsets[r]:offsets[r + 1]]`. Both are memory-mapped, so loading them is instant.
+
+The store lives in a folder per tokenizer (and max_length), and it holds every unique caption it has ever seen. For each caption column we also save a small `rows_<hash>.npy` that points every row of that column to its caption in the store; the hash is computed from the captions themselves, so if the csv changes we get a new hash and only the captions that are not in the store yet go through the tokenizer.
+"""
+
+def _save_npy(path, array):
+    # write next to the target and rename, so a crash never leaves half a file behind
+    with open(f"{path}.tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(f"{path}.tmp", path)
+
+
+def _token_store_dir(cache_path, tokenizer):
+    tokenizer_name = re.sub(r"[^A-Za-z0-9_.-]", "_", tokenizer.name_or_path)
+    return f"{cache_path}/{tokenizer_name}-{CFG.max_length}"
+
+
+def _update_token_store(store_dir, captions, tokenizer, rows_path):
+    os.makedirs(store_dir, exist_ok=True)
+    if os.path.exists(f"{store_dir}/captions.json"):
+        with open(f"{store_dir}/captions.json") as f:
+            stored_captions = json.load(f)
+        input_ids = np.load(f"{store_dir}/input_ids.npy")
+        offsets = np.load(f"{store_dir}/offsets.npy")
+    else:
+        stored_captions = []
+        input_ids = np.zeros(0, dtype=np.int32)
+        offsets = np.zeros(1, dtype=np.int64)
+    caption_rows = {caption: row for row, caption in enumerate(stored_captions)}
+
+    new_captions = [caption for caption in dict.fromkeys(captions) if caption not in caption_rows]
+    if new_captions:
+        encoded_captions = tokenizer(
+            new_captions, padding=False, truncation=True, max_length=CFG.max_length
+        )["input_ids"]
+        new_input_ids, new_offsets = flatten_token_ids(encoded_captions)
+        input_ids = np.concatenate([input_ids, new_input_ids])
+        offsets = np.concatenate([offsets, offsets[-1] + new_offsets[1:]])
+        for caption in new_captions:
+            caption_rows[caption] = len(stored_captions)
+            stored_captions.append(caption)
+
+        _save_npy(f"{store_dir}/input_ids.npy", input_ids)
+        _save_npy(f"{store_dir}/offsets.npy", offsets)
+        with open(f"{store_dir}/captions.json.tmp", "w") as f:
+            json.dump(stored_captions, f)
+        os.replace(f"{store_dir}/captions.json.tmp", f"{store_dir}/captions.json")
+
+    _save_npy(rows_path, np.array([caption_rows[caption] for caption in captions], dtype=np.int64))
+
+
+def load_token_store(captions, tokenizer, cache_path):
+    """
+    returns input_ids, offsets and rows; the tokens of captions[i] are
+    input_ids[offsets[rows[i]]:offsets[rows[i] + 1]]
+    """
+    captions = [str(caption) for caption in captions]
+    store_dir = _token_store_dir(cache_path, tokenizer)
+    column_hash = hashlib.sha1("\0".join(captions).encode("utf-8")).hexdigest()
+    rows_path = f"{store_dir}/rows_{column_hash}.npy"
+    if not os.path.exists(rows_path):
+        _update_token_store(store_dir, captions, tokenizer, rows_path)
+
+    input_ids = np.load(f"{store_dir}/input_ids.npy", mmap_mode="r")
+    offsets = np.load(f"{store_dir}/offsets.npy", mmap_mode="r")
+    return input_ids, offsets, np.load(rows_path)
+
 """## Image Encoder
 
 The image encoder code is straight forward. I'm using PyTorch Image Models library (timm) here which makes a lot of different image models available from ResNets to EfficientNets and many more. Here we will use a ResNet50 as our image encoder. You can easily use torchvision library to use ResNets if you don't want to install a new library.
 
 The code encodes each image to a fixed size vector with the size of the model's output channels (in case of ResNet50 the vector size will be **2048**). This is the output after the nn.AdaptiveAvgPool2d() layer.
+
+If the batch arrives as uint8 (`CFG.normalize_on_device`), the encoder does the ImageNet mean/std normalization itself. `(x / 255 - mean) / std` is the same as `x * (1 / (255 * std)) - mean / std`, so the whole batch is normalized with a single multiply-add on the device, and the workers only have to send a quarter of the bytes.
 """
 
 class ImageEncoder(nn.Module):
@@ -222,7 +870,8 @@ class ImageEncoder(nn.Module):
     """
 
     def __init__(
-        self, model_name=CFG.model_name, pretrained=CFG.pretrained, trainable=CFG.trainable
+        self, model_name=CFG.model_name, pretrained=CFG.pretrained, trainable=CFG.trainable,
+        grad_checkpointing=CFG.image_grad_checkpointing,
     ):
         super().__init__()
         self.model = timm.create_model(
@@ -230,10 +879,40 @@ class ImageEncoder(nn.Module):
         )
         for p in self.model.parameters():
             p.requires_grad = trainable
+        self.set_grad_checkpointing(grad_checkpointing)
+
+        # same mean/std as A.Normalize; not persistent so old checkpoints still load
+        mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+        self.register_buffer("pixel_scale", 1.0 / (255.0 * std), persistent=False)
+        self.register_buffer("pixel_shift", -mean / std, persistent=False)
+
+    def set_grad_checkpointing(self, enable=True):
+        # checkpoints every stage (layer1 ... layer4 for a ResNet). Not timm's own
+        # set_grad_checkpointing: depending on the version it checkpoints reentrantly,
+        # which gives no gradients when the stage inputs do not require grad (frozen
+        # stages in front of LoRA adapters). The forwards are wrapped on the instance,
+        # so the parameter names stay the same.
+        stages = getattr(self.model, "stages", None)
+        if stages is None:
+            stages = [getattr(self.model, f"layer{i}") for i in range(1, 5) if hasattr(self.model, f"layer{i}")]
+        for stage in stages:
+            if enable:
+                stage.forward = checkpointed(type(stage).forward.__get__(stage))
+            else:
+                stage.__dict__.pop("forward", None)
 
     def forward(self, x):
+        if x.dtype == torch.uint8:
+            x = torch.addcmul(self.pixel_shift, x.float(), self.pixel_scale)
         return self.model(x)
 
+
+def checkpointed(forward):
+    def checkpointed_forward(*args, **kwargs):
+        return torch.utils.checkpoint.checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return checkpointed_forward
+
 """## Text Encoder
 
 As I mentioned before, I'll use DistilBERT as the text encoder. Like its bigger brother BERT, two special tokens will be added to the actual input tokens: **CLS** and **SEP** which mark the start and end of a sentence. To grab the whole representation of a sentence (as the related BERT and DistilBERT papers point out) we use the final representations of the CLS token and we hope that this representation captures the overall meaning of the sentence (caption). Thinking it in this way, it is similar to what we did to images and converted them into a fixed size vector.
@@ -242,7 +921,10 @@ In the case of DistilBERT (and also BERT) the output hidden representation for e
 """
 
 class TextEncoder(nn.Module):
-    def __init__(self, model_name=CFG.text_encoder_model, pretrained=CFG.pretrained, trainable=CFG.trainable):
+    def __init__(
+        self, model_name=CFG.text_encoder_model, pretrained=CFG.pretrained, trainable=CFG.trainable,
+        grad_checkpointing=CFG.text_grad_checkpointing,
+    ):
         super().__init__()
         if pretrained:
             self.model = DistilBertModel.from_pretrained(model_name)
@@ -251,10 +933,19 @@ class TextEncoder(nn.Module):
 
         for p in self.model.parameters():
             p.requires_grad = trainable
+        self.set_grad_checkpointing(grad_checkpointing)
 
         # we are using the CLS token hidden representation as the sentence's embedding
         self.target_token_idx = 0
 
+    def set_grad_checkpointing(self, enable=True):
+        # HuggingFace checkpoints every transformer layer; the non-reentrant version
+        # also works when the inputs do not require grad
+        if enable:
+            self.model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        else:
+            self.model.gradient_checkpointing_disable()
+
     def forward(self, input_ids, attention_mask):
         output = self.model(input_ids=input_ids, attention_mask=attention_mask)
         last_hidden_state = output.last_hidden_state
@@ -321,17 +1012,89 @@ class CLIPModel(nn.Module):
         self.image_projection = ProjectionHead(embedding_dim=image_embedding)
         self.text_projection = ProjectionHead(embedding_dim=text_embedding)
         self.temperature = temperature
+        # set by add_lora: the BatchNorm layers of the frozen encoders keep their running statistics
+        self.frozen_batchnorm = False
+        if CFG.queue_size:
+            if CFG.loss_chunk_size:
+                raise ValueError("queue_size and loss_chunk_size cannot be used together")
+            # ring buffers of past embeddings, see queue_contrastive_loss; not saved in checkpoints
+            self.register_buffer(
+                "image_queue", torch.zeros(CFG.queue_size, CFG.projection_dim), persistent=False
+            )
+            self.register_buffer(
+                "text_queue", torch.zeros(CFG.queue_size, CFG.projection_dim), persistent=False
+            )
+            # the image id of every queued row, so that copies of a batch's own images are skipped
+            self.register_buffer(
+                "id_queue", torch.full((CFG.queue_size,), -1, dtype=torch.long), persistent=False
+            )
+            self.queue_ptr = 0
+            self.queue_filled = 0
+
+    def train(self, mode=True):
+        super().train(mode)
+        if mode and self.frozen_batchnorm:
+            for encoder in (self.image_encoder, self.text_encoder):
+                for module in encoder.modules():
+                    if isinstance(module, (nn.BatchNorm1d, nn.BatchNorm2d)):
+                        module.eval()
+        return self
 
     def forward(self, batch):
+        image_embeddings, text_embeddings = self.encode(batch)
+
+        # the loss always runs in float32: under autocast the logits, the softmax
+        # targets and the log-softmax would otherwise be computed in bf16/fp16
+        with torch.autocast(device_type=image_embeddings.device.type, enabled=False):
+            return self.contrastive_loss(
+                image_embeddings.float(), text_embeddings.float(), batch.get("image_id")
+            )
+
+    def encode(self, batch):
         # Getting Image and Text Features
-        image_features = self.image_encoder(batch["image"])
-        text_features = self.text_encoder(
-            input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]
-        )
+        if "image_features" in batch:
+            # frozen encoders: the features were computed once by cache_backbone_features
+            image_features = batch["image_features"]
+            text_features = batch["text_features"]
+        else:
+            image_features = self.image_encoder(batch["image"])
+            text_features = self.text_encoder(
+                input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]
+            )
         # Getting Image and Text Embeddings (with same dimension)
         image_embeddings = self.image_projection(image_features)
         text_embeddings = self.text_projection(text_features)
-
+        return image_embeddings, text_embeddings
+
+    def contrastive_loss(self, image_embeddings, text_embeddings, image_ids=None):
+        if self.training and is_distributed():
+            # negatives from every rank: the loss is over the global batch
+            image_embeddings = gather_embeddings(image_embeddings)
+            text_embeddings = gather_embeddings(text_embeddings)
+            if image_ids is not None:
+                image_ids = gather_embeddings(image_ids)
+        if self.training and CFG.queue_size:
+            return self.queue_contrastive_loss(image_embeddings, text_embeddings, image_ids)
+        if CFG.loss_targets == "identity":
+            # every batch holds each image once, so caption i only matches image i
+            logits = (text_embeddings @ image_embeddings.T) / self.temperature
+            labels = torch.arange(len(logits), device=logits.device)
+            return (F.cross_entropy(logits, labels) + F.cross_entropy(logits.T, labels)) / 2.0
+        if CFG.loss_targets == "image_id":
+            if image_ids is None:
+                raise ValueError('loss_targets = "image_id" needs the image_id of every row in the batch')
+            # multi-positive InfoNCE: the target mass is split over all rows with the same image
+            logits = (text_embeddings @ image_embeddings.T) / self.temperature
+            positives = (image_ids[:, None] == image_ids[None, :]).float()
+            targets = positives / positives.sum(dim=1, keepdim=True)
+            # the mask is symmetric, so targets.T has the same rows as targets
+            texts_loss = cross_entropy(logits, targets, reduction='none')
+            images_loss = cross_entropy(logits.T, targets, reduction='none')
+            return ((images_loss + texts_loss) / 2.0).mean()
+        if CFG.loss_chunk_size:
+            return ChunkedContrastiveLoss.apply(
+                image_embeddings, text_embeddings, self.temperature, CFG.loss_chunk_size
+            )
         # Calculating the Loss
         logits = (text_embeddings @ image_embeddings.T) / self.temperature
         images_similarity = image_embeddings @ image_embeddings.T
@@ -344,10 +1107,58 @@ class CLIPModel(nn.Module):
         loss =  (images_loss + texts_loss) / 2.0 # shape: (batch_size)
         return loss.mean()
 
+    def batch_targets(self, image_embeddings, text_embeddings, image_ids):
+        # the in-batch targets of each CFG.loss_targets mode (the rows are captions, the columns images)
+        if CFG.loss_targets == "identity":
+            return torch.eye(len(image_embeddings), device=image_embeddings.device)
+        if CFG.loss_targets == "image_id":
+            positives = (image_ids[:, None] == image_ids[None, :]).float()
+            return positives / positives.sum(dim=1, keepdim=True)
+        images_similarity = image_embeddings @ image_embeddings.T
+        texts_similarity = text_embeddings @ text_embeddings.T
+        return F.softmax(
+            (images_similarity + texts_similarity) / 2 * self.temperature, dim=-1
+        )
+
+    def queue_contrastive_loss(self, image_embeddings, text_embeddings, image_ids):
+        # the batch part uses the usual targets; the queued embeddings only add columns with target 0
+        if image_ids is None:
+            raise ValueError("the embedding queue needs the image_id of every row in the batch")
+        targets = self.batch_targets(image_embeddings, text_embeddings, image_ids)
+        image_queue = self.image_queue[:self.queue_filled]
+        text_queue = self.text_queue[:self.queue_filled]
+        # a queued copy of a row's own screenshot is not a negative: its logit is set to the
+        # lowest finite value (-inf would turn the 0 target into nan), so it drops out of the softmax
+        same_image = image_ids[:, None] == self.id_queue[None, :self.queue_filled]
+        lowest = torch.finfo(text_embeddings.dtype).min
+        texts_logits = torch.cat([
+            text_embeddings @ image_embeddings.T / self.temperature,
+            (text_embeddings @ image_queue.T / self.temperature).masked_fill(same_image, lowest),
+        ], dim=1)
+        images_logits = torch.cat([
+            image_embeddings @ text_embeddings.T / self.temperature,
+            (image_embeddings @ text_queue.T / self.temperature).masked_fill(same_image, lowest),
+        ], dim=1)
+        texts_loss = cross_entropy(texts_logits, F.pad(targets, (0, self.queue_filled)))
+        images_loss = cross_entropy(images_logits, F.pad(targets.T, (0, self.queue_filled)))
+        loss = (images_loss + texts_loss) / 2.0
+        self.enqueue(image_embeddings, text_embeddings, image_ids)
+        return loss.mean()
+
+    @torch.no_grad()
+    def enqueue(self, image_embeddings, text_embeddings, image_ids):
+        queue_size = len(self.image_queue)
+        n = min(len(image_embeddings), queue_size)
+        rows = (self.queue_ptr + torch.arange(n, device=self.image_queue.device)) % queue_size
+        self.image_queue.index_copy_(0, rows, image_embeddings[-n:].detach().to(self.image_queue.dtype))
+        self.text_queue.index_copy_(0, rows, text_embeddings[-n:].detach().to(self.text_queue.dtype))
+        self.id_queue.index_copy_(0, rows, image_ids[-n:].to(self.id_queue.device, torch.long))
+        self.queue_ptr = (self.queue_ptr + n) % queue_size
+        self.queue_filled = min(self.queue_filled + n, queue_size)
+
 
 def cross_entropy(preds, targets, reduction='none'):
-    log_softmax = nn.LogSoftmax(dim=-1)
-    loss = (-targets * log_softmax(preds)).sum(1)
+    loss = (-targets * F.log_softmax(preds, dim=-1)).sum(1)
     if reduction == "none":
         return loss
     elif reduction == "mean":
@@ -361,20 +1172,158 @@ Now that we've got our targets matrix, we will use simple cross entropy to calcu
 
 **Here's why I didn't use a simpler approach**: I need to admit that there's a simpler way to calculate this loss in PyTorch; by doing this: nn.CrossEntropyLoss()(logits, torch.arange(batch_size)). Why I did not use it here? For 2 reasons. 1- The dataset we are using has multiple captions for a single image; so, there is the possibility that two identical images with their similar captions exist in a batch (it is rare but it can happen). Taking the loss with this easier method will ignore this possibility and the model learns to pull apart two representations (assume them different)  that are actually the same. Obviously, we don't want this to happen so I calculated the whole target matrix in a way that takes care of these edge cases. 2- Doing it the way I did, gave me a better understanding of what is happening in this loss function; so, I thought it would give you a better intuition as well!
 
-## Train
+### Chunked Loss for Large Batches
+
+The loss above materializes `logits`, `images_similarity`, `texts_similarity` and `targets`, all of shape (batch_size, batch_size), plus the log-softmax and the product inside `cross_entropy` and everything autograd keeps for the backward pass. That grows quadratically with the batch size, and bigger batches are exactly what gives the contrastive loss better negatives.
+
+`ChunkedContrastiveLoss` computes the same number, with the same gradients, a few rows at a time. Writing `r` for the row log-sum-exp of the logits, `c` for the column log-sum-exp and `P` for the soft targets, the loss is
+
+`sum_ij P_ij * (r_i + c_j - 2 * logits_ij) / (2 * batch_size)`
+
+The forward pass goes over the rows twice: the first pass collects `r`, `c` (with a running log-sum-exp over chunks) and the column sums of `P`, and the second pass sums up the loss. Only these three vectors are saved for backward. The backward pass recomputes each chunk of logits and targets and turns it into gradients for the embeddings directly; the gradient of the loss with respect to the logits is `(softmax_rows + softmax_columns * colsum(P) - 2 * P) / (2 * batch_size)`, and through the targets it is the usual softmax backward. Peak memory is `chunk_size x batch_size` instead of `batch_size x batch_size`, so it grows linearly with the batch size. The price is computing the logits and targets three times instead of once, which is cheap next to the encoders.
+"""
+
+class ChunkedContrastiveLoss(torch.autograd.Function):
+    @staticmethod
+    def _blocks(image_embeddings, text_embeddings, temperature, start, end):
+        logits = text_embeddings[start:end] @ image_embeddings.T / temperature
+        similarity = (
+            image_embeddings[start:end] @ image_embeddings.T
+            + text_embeddings[start:end] @ text_embeddings.T
+        )
+        targets = F.softmax(similarity / 2 * temperature, dim=-1)
+        return logits, targets
+
+    @staticmethod
+    def forward(ctx, image_embeddings, text_embeddings, temperature, chunk_size):
+        batch_size = len(image_embeddings)
+        row_lse = image_embeddings.new_empty(batch_size)
+        col_lse = image_embeddings.new_full((batch_size,), float("-inf"))
+        target_col_sums = image_embeddings.new_zeros(batch_size)
+        for start in range(0, batch_size, chunk_size):
+            logits, targets = ChunkedContrastiveLoss._blocks(
+                image_embeddings, text_embeddings, temperature, start, start + chunk_size
+            )
+            row_lse[start:start + chunk_size] = torch.logsumexp(logits, dim=-1)
+            col_lse = torch.logaddexp(col_lse, torch.logsumexp(logits, dim=0))
+            target_col_sums += targets.sum(dim=0)
+
+        loss = image_embeddings.new_zeros(())
+        for start in range(0, batch_size, chunk_size):
+            logits, targets = ChunkedContrastiveLoss._blocks(
+                image_embeddings, text_embeddings, temperature, start, start + chunk_size
+            )
+            weights = row_lse[start:start + chunk_size, None] + col_lse[None, :] - 2 * logits
+            loss += (targets * weights).sum()
+
+        ctx.save_for_backward(image_embeddings, text_embeddings, row_lse, col_lse, target_col_sums)
+        ctx.temperature = temperature
+        ctx.chunk_size = chunk_size
+        return loss / (2 * batch_size)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        image_embeddings, text_embeddings, row_lse, col_lse, target_col_sums = ctx.saved_tensors
+        temperature, chunk_size = ctx.temperature, ctx.chunk_size
+        batch_size = len(image_embeddings)
+        scale = grad_output / (2 * batch_size)
+        grad_image = torch.zeros_like(image_embeddings)
+        grad_text = torch.zeros_like(text_embeddings)
+        for start in range(0, batch_size, chunk_size):
+            end = start + chunk_size
+            logits, targets = ChunkedContrastiveLoss._blocks(
+                image_embeddings, text_embeddings, temperature, start, end
+            )
+            weights = row_lse[start:end, None] + col_lse[None, :] - 2 * logits
+            row_softmax = torch.exp(logits - row_lse[start:end, None])
+            col_softmax = torch.exp(logits - col_lse[None, :])
+            grad_logits = (row_softmax + col_softmax * target_col_sums[None, :] - 2 * targets) * scale
+            grad_similarity = targets * (weights - (targets * weights).sum(dim=-1, keepdim=True)) * scale
+
+            # logits = text @ image.T / temperature
+            grad_text[start:end] += grad_logits @ image_embeddings / temperature
+            grad_image += grad_logits.T @ text_embeddings[start:end] / temperature
+            # similarity = (image @ image.T + text @ text.T) / 2 * temperature
+            grad_similarity = grad_similarity * (temperature / 2)
+            grad_image[start:end] += grad_similarity @ image_embeddings
+            grad_image += grad_similarity.T @ image_embeddings[start:end]
+            grad_text[start:end] += grad_similarity @ text_embeddings
+            grad_text += grad_similarity.T @ text_embeddings[start:end]
+        return grad_image, grad_text, None, None
+
+"""A quick check that the chunked loss matches the full-matrix loss, both the value and the gradients (on a small random batch, in float64):"""
+
+def check_chunked_loss(batch_size=10, dim=8, chunk_size=3, temperature=1.0):
+    image_embeddings = torch.randn(batch_size, dim, dtype=torch.float64, requires_grad=True)
+    text_embeddings = torch.randn(batch_size, dim, dtype=torch.float64, requires_grad=True)
+
+    logits = (text_embeddings @ image_embeddings.T) / temperature
+    targets = F.softmax(
+        (image_embeddings @ image_embeddings.T + text_embeddings @ text_embeddings.T) / 2 * temperature, dim=-1
+    )
+    texts_loss = cross_entropy(logits, targets, reduction='none')
+    images_loss = cross_entropy(logits.T, targets.T, reduction='none')
+    dense_loss = ((images_loss + texts_loss) / 2.0).mean()
+    dense_grads = torch.autograd.grad(dense_loss, (image_embeddings, text_embeddings))
+
+    chunked_loss = ChunkedContrastiveLoss.apply(image_embeddings, text_embeddings, temperature, chunk_size)
+    chunked_grads = torch.autograd.grad(chunked_loss, (image_embeddings, text_embeddings))
+
+    assert torch.allclose(dense_loss, chunked_loss)
+    assert all(torch.allclose(dense, chunked) for dense, chunked in zip(dense_grads, chunked_grads))
+    print("chunked loss matches the full-matrix loss")
+
+check_chunked_loss()
+
+"""### Batches Without Repeated Images
+
+The soft targets above are only there because a batch can hold the same screenshot twice (Rico has about five captions per screen). With `CFG.unique_batches`, `build_loaders` uses `UniqueKeyBatchSampler`, which never puts two rows with the same image (or, with `CFG.unique_batch_key = "activity_name"`, the same app) in one batch. Then caption `i` only matches image `i`, and `CFG.loss_targets = "identity"` uses plain `arange` targets: no image-image and text-text matrices and no softmax over them.
+
+The sampler fills the batches first-fit, so the rows that are left at the end of an epoch mostly share one key. With `"activity_name"` that is the "android" app (1,010 of the 21,550 rows), which would leave about 350 batches of a single row. Their loss is 0 while AdamW still takes a step, and they would also pull the valid loss down. So the leftover batches smaller than `CFG.unique_min_batch_size` are dropped. In training those rows come back in other epochs because the order is reshuffled, but the valid loss always leaves out the same few rows.
+
+Without the special sampler there is a cheaper way to find the repeated images than comparing embeddings: the datasets return an integer `image_id` for every row (the same for all the captions of a screenshot). With `CFG.loss_targets = "image_id"` the positives are the rows whose ids are equal, a boolean compare instead of two batch x batch x 256 matmuls, and every caption spreads its target evenly over all the copies of its image.
+"""
+
+"""### Embedding Queue
+
+Even with a bigger batch, every caption is only compared to the screenshots of its own batch. With `CFG.queue_size` set, `CLIPModel` keeps the image and text embeddings of the most recent samples (a few thousand is a good size) in two preallocated ring buffers that are overwritten in place, oldest first. During training, the queued image embeddings are added as extra negatives for every caption and the queued text embeddings as extra negatives for every image: they just add columns to the logits, with a target of 0. So the loss sees thousands of negatives, and the encoders still only run on the current batch.
+
+The queued embeddings are detached and were computed by slightly older weights, so they get no gradient and drift a bit behind the model; that is why the queue should not be too long compared to how fast the model changes. The queue is only used in training (the validation loss stays comparable across runs) and it is not saved in `best.pt`. The in-batch part of the loss keeps the targets of `CFG.loss_targets`; the chunked loss cannot be combined with the queue.
+
+Rico has about five captions per screenshot, so with a queue of a few thousand rows most captions would find another copy of their own screenshot in the queue, and a target of 0 would push them away from it: exactly the false negatives the soft targets are there to avoid. So the queue also keeps the `image_id` of every row, and the queued columns of a row's own screenshot are left out of its softmax.
+"""
+
+"""## Train
 
 Here are some funtions to help us load train and valid dataloaders, our model and then train and evaluate our model on those. There's not much going on here; just simple training loop and utility functions
 """
 
-def make_train_valid_dfs():
-    dataframe = pd.read_csv(f"{CFG.captions_path}/captions.csv")
+@functools.lru_cache(maxsize=4)
+def read_captions(captions_file, mtime):
+    # mtime is part of the cache key, so an edited csv is read again
+    return pd.read_csv(captions_file)
+
+
+def make_train_valid_dfs(seed=42, valid_fraction=0.2):
+    captions_file = f"{CFG.captions_path}/captions.csv"
+    dataframe = read_captions(captions_file, os.path.getmtime(captions_file))
     max_id = dataframe["id"].max() + 1 if not CFG.debug else 100
-    image_ids = np.arange(0, max_id)
-    np.random.seed(42)
-    valid_ids = np.random.choice(
-        image_ids, size=int(0.2 * len(image_ids)), replace=False
-    )
-    train_ids = [id_ for id_ in image_ids if id_ not in valid_ids]
+    # the split only depends on these three numbers, so it is computed once and saved
+    manifest_path = f"{CFG.captions_path}/split_seed{seed}_valid{valid_fraction}_ids{max_id}.npz"
+    if os.path.exists(manifest_path):
+        split = np.load(manifest_path)
+        train_ids, valid_ids = split["train_ids"], split["valid_ids"]
+    else:
+        image_ids = np.arange(0, max_id)
+        np.random.seed(seed)
+        valid_ids = np.random.choice(
+            image_ids, size=int(valid_fraction * len(image_ids)), replace=False
+        )
+        train_ids = np.setdiff1d(image_ids, valid_ids, assume_unique=True)
+        # same tmp file + rename as _save_npy, so nobody ever loads half a manifest
+        with open(f"{manifest_path}.tmp", "wb") as f:
+            np.savez(f, train_ids=train_ids, valid_ids=valid_ids)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
     train_dataframe = dataframe[dataframe["id"].isin(train_ids)].reset_index(drop=True)
     valid_dataframe = dataframe[dataframe["id"].isin(valid_ids)].reset_index(drop=True)
     return train_dataframe, valid_dataframe
@@ -388,114 +1337,1086 @@ def build_loaders(dataframe, tokenizer, mode):
         tokenizer=tokenizer,
         transforms=transforms,
     )
+    collate_fn = functools.partial(
+        collate_captions, pad_token_id=tokenizer.pad_token_id,
+        pad_to_multiple_of=CFG.pad_to_multiple_of,
+    )
+    if CFG.unique_batches:
+        # for the valid loader too, so that the valid loss uses the same targets; it reorders
+        # the rows, so embedding a dataframe in order goes through build_embedding_loader
+        batch_sampler = UniqueKeyBatchSampler(
+            dataframe[CFG.unique_batch_key].values, CFG.batch_size,
+            shuffle=mode == "train",
+            drop_last=is_distributed(),
+            min_batch_size=CFG.unique_min_batch_size,
+            seed=CFG.seed,
+            num_replicas=dist.get_world_size() if is_distributed() else 1,
+            rank=dist.get_rank() if is_distributed() else 0,
+        )
+        return torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=CFG.num_workers,
+            collate_fn=collate_fn,
+        )
+    if mode == "train" and CFG.bucket_by_length:
+        batch_sampler = LengthBucketBatchSampler(
+            dataset.caption_lengths, CFG.batch_size, bucket_size=CFG.bucket_size,
+            # the gathered loss needs the same batch size on every rank
+            drop_last=is_distributed(),
+            seed=CFG.seed,
+            num_replicas=dist.get_world_size() if is_distributed() else 1,
+            rank=dist.get_rank() if is_distributed() else 0,
+        )
+        return torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=CFG.num_workers,
+            collate_fn=collate_fn,
+        )
+    if is_distributed():
+        # pads every rank to the same number of samples, so batch sizes match across ranks
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            dataset, shuffle=True if mode == "train" else False, seed=CFG.seed
+        )
+        return torch.utils.data.DataLoader(
+            dataset,
+            batch_size=CFG.batch_size,
+            num_workers=CFG.num_workers,
+            sampler=sampler,
+            collate_fn=collate_fn,
+        )
     dataloader = torch.utils.data.DataLoader(
         dataset,
         batch_size=CFG.batch_size,
         num_workers=CFG.num_workers,
-        shuffle=True if mode == "train" else False,
+        sampler=shuffled_sampler(dataset) if mode == "train" else None,
+        collate_fn=collate_fn,
     )
     return dataloader
 
-"""Here's a handy function to train our model. There's not much happening here; just loading the batches, feeding them to the model and stepping the optimizer and lr_scheduler."""
 
-def train_epoch(model, train_loader, optimizer, lr_scheduler, step):
-    loss_meter = AvgMeter()
-    tqdm_object = tqdm(train_loader, total=len(train_loader))
-    for batch in tqdm_object:
+def build_embedding_loader(dataframe, tokenizer):
+    # every row once and in order, in this process only: for embedding a dataframe, not for training
+    dataset = CLIPDataset(
+        dataframe["image"].values,
+        dataframe["caption"].values,
+        tokenizer=tokenizer,
+        transforms=get_transforms(mode="valid"),
+    )
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=CFG.batch_size,
+        num_workers=CFG.num_workers,
+        collate_fn=functools.partial(
+            collate_captions, pad_token_id=tokenizer.pad_token_id,
+            pad_to_multiple_of=CFG.pad_to_multiple_of,
+        ),
+    )
+
+
+def shuffled_sampler(dataset):
+    # a RandomSampler with its own generator, which set_loader_epoch reseeds every epoch
+    return torch.utils.data.RandomSampler(dataset, generator=torch.Generator())
+
+"""## Sharded Dataset
+
+For the full Rico corpus (~66k screens) and for future crawls, keeping every screenshot as its own file is slow: each sample costs a file open and a metadata lookup, and that is what dominates on network or Drive mounts. `write_shards` packs the screens into tar shards instead. Every screen becomes two consecutive members of a shard: `<key>.jpg` with the original jpg bytes, and `<key>.json` with its captions, their token ids, activity_name and negimages. The captions are tokenized once while writing (through the token store when `CFG.token_cache_path` is set), so the workers do not run the tokenizer again in every epoch. The screens are shuffled before packing, so a shard is not just one app. An `index.json` next to the shards stores the tokenizer and how many captions each shard holds. It is written last, so a folder without it is an unfinished write.
+
+`ShardedCLIPDataset` is the `IterableDataset` counterpart of `CLIPDataset`. It reads whole shards sequentially (so the disk only sees large sequential reads), decodes each screen once for all of its captions and mixes the samples with a shuffle buffer. Every rank and every DataLoader worker streams its own subset of the shards. The shard order is shuffled with `CFG.seed` and the epoch, so all of them draw the same order and split it without overlap. The shards do not hold exactly the same number of captions, so each worker stops after as many samples as its counterpart on the smallest rank gets. Every rank then runs the same number of batches, which the gathered loss needs. You need at least `world_size * num_workers` shards, otherwise some workers stay empty.
+
+With `CFG.shard_path` set, `main()` trains from shards: `build_shard_loader` writes one set of shards per split (named after a hash of its rows, like the feature cache) the first time and reads them after that.
+"""
+
+def _add_tar_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(dataframe, shard_path, tokenizer, images_per_shard=1000, image_path=None, seed=42):
+    os.makedirs(shard_path, exist_ok=True)
+    dataframe = dataframe.reset_index(drop=True)
+    captions = dataframe["caption"].astype(str).tolist()
+    if CFG.token_cache_path is not None:
+        input_ids, token_offsets, token_rows = load_token_store(
+            captions, tokenizer, CFG.token_cache_path
+        )
+    else:
+        encoded_captions = tokenizer(
+            captions, padding=False, truncation=True, max_length=CFG.max_length
+        )
+        input_ids, token_offsets = flatten_token_ids(encoded_captions["input_ids"])
+        token_rows = np.arange(len(captions))
+    groups = list(dataframe.groupby("image", sort=False))
+    random.Random(seed).shuffle(groups)
+
+    caption_counts = {}
+    for start in tqdm(range(0, len(groups), images_per_shard)):
+        shard_filename = f"shard-{start // images_per_shard:05d}.tar"
+        caption_counts[shard_filename] = 0
+        with tarfile.open(f"{shard_path}/{shard_filename}", "w") as tar:
+            for image_filename, rows in groups[start:start + images_per_shard]:
+                key = os.path.splitext(image_filename)[0]
+                meta = {
+                    "image": image_filename,
+                    "captions": rows["caption"].astype(str).tolist(),
+                    "input_ids": [
+                        input_ids[token_offsets[row]:token_offsets[row + 1]].tolist()
+                        for row in token_rows[rows.index]
+                    ],
+                    "activity_name": rows["activity_name"].iloc[0] if "activity_name" in rows else None,
+                    "negimages": rows["negimage"].tolist() if "negimage" in rows else None,
+                }
+                _add_tar_member(tar, f"{key}.jpg", read_image_bytes(image_filename, image_path))
+                _add_tar_member(tar, f"{key}.json", json.dumps(meta).encode("utf-8"))
+                caption_counts[shard_filename] += len(rows)
+
+    index = {
+        "tokenizer": tokenizer.name_or_path,
+        "max_length": CFG.max_length,
+        "caption_counts": caption_counts,
+    }
+    with open(f"{shard_path}/index.json.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{shard_path}/index.json.tmp", f"{shard_path}/index.json")
+    return [f"{shard_path}/{shard_filename}" for shard_filename in caption_counts]
+
+
+class ShardedCLIPDataset(torch.utils.data.IterableDataset):
+    def __init__(
+        self, shard_path, tokenizer, transforms, shuffle=True, shuffle_buffer=1000, seed=42,
+        num_replicas=1, rank=0,
+    ):
+        with open(f"{shard_path}/index.json") as f:
+            index = json.load(f)
+        self.caption_counts = index["caption_counts"]
+        self.shard_path = shard_path
+        # shards written with another tokenizer are tokenized again while reading
+        self.stored_tokens = (
+            index["tokenizer"] == tokenizer.name_or_path and index["max_length"] == CFG.max_length
+        )
+        self.tokenizer = tokenizer
+        self.transforms = transforms
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _worker_shards(self):
+        """
+        returns the shards of this rank and worker, how many samples to read from
+        them (so that the same worker on every rank yields the same number) and
+        the seed of its shuffle buffer
+        """
+        shard_filenames = list(self.caption_counts)
+        if self.shuffle:
+            random.Random(f"{self.seed}-{self.epoch}").shuffle(shard_filenames)
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        n_slices = self.num_replicas * num_workers
+        slices = [
+            shard_filenames[rank * num_workers + worker_id::n_slices]
+            for rank in range(self.num_replicas)
+        ]
+        n_samples = min(
+            sum(self.caption_counts[shard_filename] for shard_filename in shard_slice)
+            for shard_slice in slices
+        )
+        shard_paths = [f"{self.shard_path}/{shard_filename}" for shard_filename in slices[self.rank]]
+        return shard_paths, n_samples, f"{self.seed}-{self.epoch}-{self.rank}-{worker_id}"
+
+    def _samples(self, shard_paths):
+        for shard_path in shard_paths:
+            image_bytes = None
+            with tarfile.open(shard_path, "r|") as tar:
+                for member in tar:
+                    data = tar.extractfile(member).read()
+                    if not member.name.endswith(".json"):
+                        image_bytes = data
+                        continue
+                    meta = json.loads(data)
+                    image = image_to_tensor(decode_image(image_bytes), self.transforms)
+                    # the same id on every worker and rank, so gathered batches can be compared
+                    image_id = zlib.crc32(meta["image"].encode())
+                    if self.stored_tokens:
+                        token_ids = meta["input_ids"]
+                    else:
+                        token_ids = self.tokenizer(
+                            meta["captions"], padding=False, truncation=True,
+                            max_length=CFG.max_length,
+                        )["input_ids"]
+                    for caption, caption_ids in zip(meta["captions"], token_ids):
+                        input_ids = torch.tensor(caption_ids, dtype=torch.long)
+                        item = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+                        item['image'] = image
+                        item['caption'] = caption
+                        item['image_id'] = image_id
+                        yield item
+
+    def _shuffled(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        shard_paths, n_samples, buffer_seed = self._worker_shards()
+        samples = itertools.islice(self._samples(shard_paths), n_samples)
+        if self.shuffle:
+            samples = self._shuffled(samples, random.Random(buffer_seed))
+        return iter(samples)
+
+    def __len__(self):
+        # about this rank's share; only used for the progress bar
+        return sum(self.caption_counts.values()) // self.num_replicas
+
+
+def _rows_hash(dataframe):
+    return hashlib.sha1(
+        pd.util.hash_pandas_object(dataframe[["image", "caption"]], index=False).values.tobytes()
+    ).hexdigest()[:16]
+
+
+def build_shard_loader(dataframe, tokenizer, mode):
+    # one set of shards per split, like the feature cache; the hash keeps another split from reusing them
+    rows_hash = _rows_hash(dataframe)
+    shard_path = f"{CFG.shard_path}/{mode}-{rows_hash}"
+    if not os.path.exists(f"{shard_path}/index.json"):
+        write_shards(
+            dataframe, shard_path, tokenizer, images_per_shard=CFG.images_per_shard, seed=CFG.seed
+        )
+    dataset = ShardedCLIPDataset(
+        shard_path,
+        tokenizer=tokenizer,
+        transforms=get_transforms(mode=mode),
+        shuffle=mode == "train",
+        shuffle_buffer=CFG.shuffle_buffer,
+        seed=CFG.seed,
+        num_replicas=dist.get_world_size() if is_distributed() else 1,
+        rank=dist.get_rank() if is_distributed() else 0,
+    )
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=CFG.batch_size,
+        num_workers=CFG.num_workers,
+        # the gathered loss needs the same batch size on every rank
+        drop_last=is_distributed(),
+        collate_fn=functools.partial(
+            collate_captions, pad_token_id=tokenizer.pad_token_id,
+            pad_to_multiple_of=CFG.pad_to_multiple_of,
+        ),
+    )
+
+"""## Frozen-Backbone Feature Cache
+
+When `CFG.trainable = False` only the two projection heads learn, but the forward pass still runs the whole ResNet50 and DistilBERT on every batch of every epoch, and they return exactly the same features each time. So we can run both encoders once over the dataset, save their outputs (2048 and 768 dimensional vectors) in memory-mapped arrays, and train the projection heads on those. An epoch then takes seconds instead of hours, which also makes it cheap to try many hyperparameters for the heads.
+
+The image features are stored once per unique screenshot, plus a row -> image index, and the text features once per caption. The cache folder name includes the encoders and a hash of the rows, so a different split or a different model gets its own cache. The features are computed with the encoders in eval mode, so BatchNorm uses its running statistics instead of the statistics of each batch.
+"""
+
+def cache_backbone_features(model, dataframe, tokenizer, cache_path):
+    os.makedirs(cache_path, exist_ok=True)
+    images = unique_images(dataframe)
+    model.eval()
+    with torch.no_grad():
+        image_loader = build_embedding_loader(images, tokenizer)
+        image_features = np.lib.format.open_memmap(
+            f"{cache_path}/image_features.npy", mode="w+", dtype=np.float32,
+            shape=(len(images), CFG.image_embedding),
+        )
+        start = 0
+        for batch in tqdm(image_loader):
+            features = model.image_encoder(batch["image"].to(CFG.device)).float().cpu().numpy()
+            image_features[start:start + len(features)] = features
+            start += len(features)
+        image_features.flush()
+
+        captions = dataframe["caption"].astype(str).tolist()
+        text_features = np.lib.format.open_memmap(
+            f"{cache_path}/text_features.npy", mode="w+", dtype=np.float32,
+            shape=(len(captions), CFG.text_embedding),
+        )
+        for start in tqdm(range(0, len(captions), CFG.batch_size)):
+            encoded_captions = tokenizer(
+                captions[start:start + CFG.batch_size], padding=True, truncation=True,
+                max_length=CFG.max_length, return_tensors="pt",
+            )
+            features = model.text_encoder(
+                input_ids=encoded_captions["input_ids"].to(CFG.device),
+                attention_mask=encoded_captions["attention_mask"].to(CFG.device),
+            )
+            text_features[start:start + len(features)] = features.float().cpu().numpy()
+        text_features.flush()
+
+    # written last: its presence means the cache is complete
+    image_rows = pd.Index(images["image"]).get_indexer(dataframe["image"])
+    _save_npy(f"{cache_path}/image_rows.npy", image_rows.astype(np.int64))
+
+
+class FeatureDataset(torch.utils.data.Dataset):
+    def __init__(self, cache_path):
+        self.image_features = np.load(f"{cache_path}/image_features.npy", mmap_mode="r")
+        self.text_features = np.load(f"{cache_path}/text_features.npy", mmap_mode="r")
+        self.image_rows = np.load(f"{cache_path}/image_rows.npy")
+
+    def __getitem__(self, idx):
+        return {
+            "image_features": torch.from_numpy(np.array(self.image_features[self.image_rows[idx]])),
+            "text_features": torch.from_numpy(np.array(self.text_features[idx])),
+            "image_id": int(self.image_rows[idx]),
+        }
+
+    def __len__(self):
+        return len(self.image_rows)
+
+
+def build_feature_loaders(model, dataframe, tokenizer, mode):
+    rows_hash = _rows_hash(dataframe)
+    encoders = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{CFG.model_name}-{CFG.text_encoder_model}")
+    cache_path = f"{CFG.feature_cache_path}/{encoders}-{mode}-{rows_hash}"
+    if not os.path.exists(f"{cache_path}/image_rows.npy"):
+        cache_backbone_features(model, dataframe, tokenizer, cache_path)
+    dataset = FeatureDataset(cache_path)
+    sampler = None
+    if is_distributed():
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            dataset, shuffle=True if mode == "train" else False, seed=CFG.seed
+        )
+    elif mode == "train":
+        sampler = shuffled_sampler(dataset)
+    # the items are two small vectors, so worker processes would only add overhead
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=CFG.batch_size,
+        sampler=sampler,
+    )
+
+"""## Gradient Caching
+
+With `batch_size = 32` every caption is contrasted against only 31 negatives, but a batch of a few thousand does not fit in memory with the ResNet50 and DistilBERT activations. Gradient caching gets around this, because the loss only needs the embeddings of the batch, not the activations of the encoders:
+
+1. embed the batch in sub-batches with `torch.no_grad()`, so no activations are kept
+2. compute the loss over all the embeddings at once and backprop it only to the embeddings (cheap, they are just batch_size x 256 tensors)
+3. run every sub-batch through the encoders again, this time with a graph, and backprop the cached gradient of its embeddings through it
+
+The result is the gradient of the full-batch loss, with the memory of a sub-batch. Each sub-batch is run twice, so a step costs about one extra forward pass. `RandContext` restores the RNG state of the first pass, so dropout draws the same masks in both passes. With large batches, also set `CFG.loss_chunk_size` so the loss itself does not build the batch_size x batch_size matrices.
+"""
+
+class RandContext:
+    """
+    Captures the RNG state when created and replays it inside the `with` block
+    """
+
+    def __init__(self):
+        self.cpu_state = torch.get_rng_state()
+        self.cuda_states = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+
+    def __enter__(self):
+        devices = list(range(torch.cuda.device_count())) if self.cuda_states is not None else []
+        self.fork = torch.random.fork_rng(devices=devices)
+        self.fork.__enter__()
+        torch.set_rng_state(self.cpu_state)
+        if self.cuda_states is not None:
+            torch.cuda.set_rng_state_all(self.cuda_states)
+
+    def __exit__(self, *exc):
+        self.fork.__exit__(*exc)
+
+
+def grad_cache_step(model, batch, sub_batch_size, scaler=None):
+    batch_size = len(next(iter(batch.values())))
+    sub_batches = [
+        {k: v[start:start + sub_batch_size] for k, v in batch.items()}
+        for start in range(0, batch_size, sub_batch_size)
+    ]
+
+    rand_states, image_embeddings, text_embeddings = [], [], []
+    with torch.no_grad():
+        for sub_batch in sub_batches:
+            rand_states.append(RandContext())
+            with amp_autocast():
+                sub_image_embeddings, sub_text_embeddings = model.encode(sub_batch)
+            image_embeddings.append(sub_image_embeddings.float())
+            text_embeddings.append(sub_text_embeddings.float())
+
+    image_embeddings = torch.cat(image_embeddings).requires_grad_()
+    text_embeddings = torch.cat(text_embeddings).requires_grad_()
+    loss = model.contrastive_loss(image_embeddings, text_embeddings, batch.get("image_id"))
+    if scaler is not None:
+        scaler.scale(loss).backward()
+    else:
+        loss.backward()
+
+    image_grads = image_embeddings.grad.split(sub_batch_size)
+    text_grads = text_embeddings.grad.split(sub_batch_size)
+    for sub_batch, rand_state, image_grad, text_grad in zip(sub_batches, rand_states, image_grads, text_grads):
+        with rand_state, amp_autocast():
+            sub_image_embeddings, sub_text_embeddings = model.encode(sub_batch)
+        torch.autograd.backward(
+            [sub_image_embeddings.float(), sub_text_embeddings.float()], [image_grad, text_grad]
+        )
+    return loss.detach()
+
+"""## Distributed Training
+
+`main()` trains in a single process, which leaves most cores of our CPU nodes idle. With `torch.distributed` (gloo backend, which works on CPUs and across nodes) every process trains on its own part of every epoch and the processes average their gradients after each backward pass. The pieces:
+
+- `build_loaders` gives every rank its own part of the data with a `DistributedSampler` (or a rank slice of the length buckets).
+- `gather_embeddings` all-gathers the image and text embeddings of every rank before the loss, so each sample is contrasted against the whole global batch: the number of negatives grows with the world size. The all-gather is differentiable, and its backward sums the gradients that every rank computes for our slice.
+- `all_reduce_gradients` averages the gradients over the ranks. We do it by hand instead of wrapping the model in `DistributedDataParallel`, because gradient caching calls the encoders several times per step, which DDP does not allow. The gradients are flattened into a few large buckets, so gloo sends a few big messages instead of one per parameter.
+- `broadcast_model` copies rank 0's weights to every rank at the start, since the projection heads are initialized randomly.
+- Only rank 0 prints progress and writes `best.pt`; the validation loss is averaged over all the ranks, so every rank makes the same scheduler decision.
+- The files that are cached on disk (the split manifest, the token store and the frozen-backbone feature cache) are only written by rank 0: `main_process_first` lets rank 0 build them while the other ranks wait at a barrier, and then they load what rank 0 wrote. The feature cache is built with a plain sequential loader (`build_embedding_loader`), so every screenshot's features land in its own row.
+"""
+
+def gather_embeddings(embeddings):
+    return torch.cat(torch.distributed.nn.functional.all_gather(embeddings.contiguous()))
+
+
+def broadcast_model(model):
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src=0)
+
+
+def all_reduce_gradients(model, bucket_numel=2 ** 24):
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    world_size = dist.get_world_size()
+    for start, end in _grad_buckets(grads, bucket_numel):
+        flat = torch.cat([grad.reshape(-1) for grad in grads[start:end]])
+        dist.all_reduce(flat)
+        flat /= world_size
+        offset = 0
+        for grad in grads[start:end]:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+
+
+def _grad_buckets(grads, bucket_numel):
+    start, numel = 0, 0
+    for end, grad in enumerate(grads, start=1):
+        numel += grad.numel()
+        if numel >= bucket_numel or end == len(grads):
+            yield start, end
+            start, numel = end, 0
+
+
+def all_reduce_meter(meter):
+    totals = torch.tensor([meter.sum, meter.count], dtype=torch.float64)
+    dist.all_reduce(totals)
+    meter.sum, meter.count = totals.tolist()
+    meter.avg = meter.sum / meter.count
+    return meter
+
+"""## Checkpoints
+
+`best.pt` only holds the weights, so a run that gets preempted on a shared node has to start again from zero. With `CFG.checkpoint_path` set, `main()` also keeps a full checkpoint, `last.pt`, every `CFG.checkpoint_every` steps and at the end of every epoch. It holds everything needed to continue as if nothing happened: the model, the optimizer and lr scheduler (and grad scaler), the epoch, the number of batches already trained in that epoch, the running train loss, the best valid loss so far and the random number generator states. When `main()` starts and finds `last.pt`, it resumes from there.
+
+Two details make this work:
+
+- The order of the batches in an epoch only depends on `(CFG.seed, epoch)`: `set_loader_epoch` reseeds the samplers at the start of every epoch. On resume `skip_batches` replays the same order and drops the batches that were already trained; it only draws their indices, it does not load or decode them.
+- Writing a 300 MB file takes a while, and the training thread should not wait for it. `CheckpointWriter` copies the state to the CPU (that has to happen before the next step changes the weights) and a background thread writes the copy. It writes to a temporary file first and renames it, so an interrupted write never replaces a good checkpoint with a broken one. `best.pt` is written the same way.
+"""
+
+def _to_cpu(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: _to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints on a background thread, one at a time: save() waits for the
+    previous write, takes a CPU copy of the state and returns while the copy is
+    written. Call wait() before the end of the run.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, state, path):
+        self.wait()
+        state = _to_cpu(state)
+        self.thread = threading.Thread(target=self._write, args=(state, path), daemon=True)
+        self.thread.start()
+
+    def _write(self, state, path):
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            torch.save(state, f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def training_state(model, optimizer, lr_scheduler, scaler, epoch, batch_idx, loss_meter, best_loss):
+    return {
+        "model": model_state_dict(model),
+        "optimizer": optimizer.state_dict(),
+        "lr_scheduler": lr_scheduler.state_dict(),
+        "scaler": scaler.state_dict() if scaler is not None else None,
+        "epoch": epoch,
+        "batch_idx": batch_idx, # batches of this epoch that are already trained
+        "loss_meter": (loss_meter.sum, loss_meter.count),
+        "best_loss": best_loss,
+        "rng": {
+            "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            "numpy": np.random.get_state(),
+            "random": random.getstate(),
+        },
+    }
+
+
+def load_training_state(path, model, optimizer, lr_scheduler, scaler):
+    # weights_only=False: the checkpoint also holds the numpy and python rng states
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    load_model_state_dict(model, state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    lr_scheduler.load_state_dict(state["lr_scheduler"])
+    if scaler is not None and state["scaler"] is not None:
+        scaler.load_state_dict(state["scaler"])
+    torch.set_rng_state(state["rng"]["torch"])
+    if state["rng"]["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["rng"]["cuda"])
+    np.random.set_state(state["rng"]["numpy"])
+    random.setstate(state["rng"]["random"])
+    loss_meter = DeviceAvgMeter()
+    loss_meter.sum, loss_meter.count = state["loss_meter"]
+    loss_meter.sync()
+    return state["epoch"], state["batch_idx"], loss_meter, state["best_loss"]
+
+
+def set_loader_epoch(loader, epoch):
+    for sampler in (loader.sampler, loader.batch_sampler, loader.dataset):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+    if isinstance(loader.sampler, torch.utils.data.RandomSampler) and loader.sampler.generator is not None:
+        loader.sampler.generator.manual_seed(CFG.seed + epoch)
+
+
+def skip_batches(loader, n_batches):
+    if n_batches == 0:
+        return loader
+    if isinstance(loader.dataset, torch.utils.data.IterableDataset):
+        # no indices to skip: the samples have to be read and thrown away
+        return itertools.islice(loader, n_batches, None)
+    # a list of index lists is a valid batch_sampler
+    batches = list(itertools.islice(loader.batch_sampler, n_batches, None))
+    return torch.utils.data.DataLoader(
+        loader.dataset,
+        batch_sampler=batches,
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+    )
+
+"""## Compiled Mode
+
+In eager mode every small op is its own kernel: `ProjectionHead.forward` alone launches a Linear, a GELU, another Linear, a Dropout, an add and a LayerNorm. With `CFG.compile`, `compile_model` runs `torch.compile` on the two encoders and the two projection heads, so inductor can fuse those into fewer kernels. It uses `nn.Module.compile`, which compiles the modules in place: the parameter names do not change and `best.pt` stays loadable with or without compilation.
+
+Compiling is slow and it happens again for every new input shape. The images always have the same size, but the captions do not, so:
+
+- With `CFG.pad_to_multiple_of` (e.g. 32), `collate_captions` rounds the padded length up, and the text encoder is compiled for fixed shapes: one graph per length bucket. Without it, the text encoder is compiled with dynamic shapes, one graph for all the lengths that is a bit less optimized.
+- `warm_up_compiled` runs a dummy batch of every length bucket (forward and backward) before training, so the compilation happens once up front and not in the middle of the first epoch.
+- Inductor's FX graph cache is kept in `CFG.compile_cache_path`, so the next run (or the next notebook session, if the folder is on Drive) reuses the compiled kernels instead of compiling again.
+
+`explain_graph_breaks` prints where dynamo had to fall back to python. Every graph break splits the model into pieces that are compiled separately, so it is worth checking before a long run (and before `compile_model`, since it resets dynamo afterwards).
+"""
+
+def compile_model(model):
+    if CFG.compile_cache_path is not None:
+        # has to be set before inductor compiles its first graph
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", CFG.compile_cache_path)
+    # one graph per length bucket, and a second one for the smaller last batch of an epoch
+    buckets = -(-CFG.max_length // CFG.pad_to_multiple_of) if CFG.pad_to_multiple_of else 1
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 4 * buckets)
+    model.image_encoder.compile(mode=CFG.compile_mode)
+    model.text_encoder.compile(mode=CFG.compile_mode, dynamic=not CFG.pad_to_multiple_of)
+    model.image_projection.compile(mode=CFG.compile_mode)
+    model.text_projection.compile(mode=CFG.compile_mode)
+    return model
+
+
+def _dummy_batch(batch_size, length):
+    if CFG.normalize_on_device:
+        image = torch.zeros((batch_size, 3, CFG.size, CFG.size), dtype=torch.uint8)
+    else:
+        image = torch.zeros((batch_size, 3, CFG.size, CFG.size))
+    return {
+        "image": image.to(CFG.device),
+        "input_ids": torch.zeros((batch_size, length), dtype=torch.long, device=CFG.device),
+        "attention_mask": torch.ones((batch_size, length), dtype=torch.long, device=CFG.device),
+    }
+
+
+def warm_up_compiled(model, batch_size=None):
+    """
+    compiles the train (forward and backward) and eval graphs of every caption
+    length bucket with a dummy batch; the train-mode forwards update the
+    BatchNorm statistics and draw dropout masks, so the buffers and the random
+    number generators are saved first and restored afterwards
+    """
+    # with gradient caching the encoders only ever see sub-batches
+    batch_size = batch_size or CFG.grad_cache_sub_batch_size or CFG.batch_size
+    if CFG.pad_to_multiple_of:
+        max_length = -(-CFG.max_length // CFG.pad_to_multiple_of) * CFG.pad_to_multiple_of
+        lengths = range(CFG.pad_to_multiple_of, max_length + 1, CFG.pad_to_multiple_of)
+    else:
+        lengths = [CFG.max_length] # dynamic shapes: one graph covers every length
+    was_training = model.training
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    rng_state = torch.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    for length in tqdm(lengths, disable=not is_main_process()):
+        batch = _dummy_batch(batch_size, length)
+        model.train()
+        with amp_autocast():
+            image_embeddings, text_embeddings = model.encode(batch)
+        (image_embeddings.float().sum() + text_embeddings.float().sum()).backward()
+        model.eval()
+        with torch.no_grad(), amp_autocast():
+            model.encode(batch)
+    model.zero_grad(set_to_none=True)
+    with torch.no_grad():
+        for name, buffer in model.named_buffers():
+            buffer.copy_(buffers[name])
+    torch.set_rng_state(rng_state)
+    if cuda_rng_state is not None:
+        torch.cuda.set_rng_state_all(cuda_rng_state)
+    model.train(was_training)
+
+
+def explain_graph_breaks(model, length=32):
+    # call this before compile_model: the reset at the end drops every compiled graph
+    batch = _dummy_batch(2, length)
+    towers = {
+        "image_encoder": (model.image_encoder, (batch["image"],)),
+        "text_encoder": (model.text_encoder, (batch["input_ids"], batch["attention_mask"])),
+    }
+    for name, (module, args) in towers.items():
+        explanation = torch._dynamo.explain(module.forward)(*args)
+        print(f"{name}: {explanation.graph_count} graphs, {explanation.graph_break_count} graph breaks")
+        for reason in explanation.break_reasons:
+            print(f"    {reason.reason}")
+    torch._dynamo.reset()
+
+"""## Gradient Checkpointing
+
+During training, every layer keeps its activations until the backward pass needs them, and with ResNet50 at 224x224 plus a transformer over up to 200 tokens, those activations (not the weights) are what limits the batch size. With `CFG.image_grad_checkpointing` / `CFG.text_grad_checkpointing` the towers only keep the inputs of every ResNet stage / transformer layer and recompute the rest during the backward: much less memory, for roughly one extra forward pass of that tower. Both are set per tower, since the text tower is usually much cheaper to recompute. The parameter names do not change, so checkpoints load either way.
+
+`benchmark_grad_checkpointing` measures the trade for our model: it trains a few steps on a dummy batch with each combination and reports the time per step and the activation memory (the CUDA peak on a GPU; on CPU the bytes of the tensors autograd keeps for the backward, counted with saved-tensor hooks).
+"""
+
+def benchmark_grad_checkpointing(batch_size=CFG.batch_size, length=64, steps=3):
+    model = CLIPModel().to(CFG.device)
+    model.train()
+    batch = _dummy_batch(batch_size, length)
+    parameter_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def train_step():
+        saved = {}
+
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in parameter_storages:
+                saved[storage.data_ptr()] = storage.nbytes()
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor), amp_autocast():
+            image_embeddings, text_embeddings = model.encode(batch)
+        (image_embeddings.float().sum() + text_embeddings.float().sum()).backward()
+        model.zero_grad(set_to_none=True)
+        return sum(saved.values())
+
+    results = []
+    for image_checkpointing, text_checkpointing in itertools.product([False, True], repeat=2):
+        model.image_encoder.set_grad_checkpointing(image_checkpointing)
+        model.text_encoder.set_grad_checkpointing(text_checkpointing)
+        train_step() # warm-up
+        if CFG.device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            # weights and the batch are already allocated; the rest of the peak is the step
+            allocated = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        for _ in range(steps):
+            saved_bytes = train_step()
+        if CFG.device.type == "cuda":
+            torch.cuda.synchronize()
+            saved_bytes = torch.cuda.max_memory_allocated() - allocated
+        results.append({
+            "image_checkpointing": image_checkpointing,
+            "text_checkpointing": text_checkpointing,
+            "ms_per_step": (time.perf_counter() - start) / steps * 1000,
+            "activation_mb": saved_bytes / 2 ** 20,
+        })
+    results = pd.DataFrame(results)
+    baseline = results.iloc[0]
+    results["time_vs_baseline"] = results["ms_per_step"] / baseline["ms_per_step"]
+    results["memory_vs_baseline"] = results["activation_mb"] / baseline["activation_mb"]
+    print(results.to_string(index=False))
+    return results
+
+# benchmark_grad_checkpointing()
+
+"""## LoRA Adapters
+
+Fine-tuning all of DistilBERT and ResNet50 means AdamW keeps two extra copies of every weight, and every `best.pt` is the whole 300+ MB model. With `CFG.lora`, `add_lora` freezes both backbones and gives a few layers a trainable low-rank update instead: the attention query and value projections of the text encoder (`CFG.lora_text_targets`) and the convolutions of the last ResNet stage (`CFG.lora_image_targets`). A `LoRALinear` computes `x W^T + b + (alpha / rank) x A^T B^T`, where `W` is the frozen pretrained weight and only `A` (rank x in) and `B` (out x rank) are trained; `LoRAConv2d` does the same with a conv down to `rank` channels followed by a 1x1 conv back up. `B` starts at zero, so training starts from exactly the pretrained model.
+
+`add_lora` changes the class of the existing modules in place instead of wrapping them, so the backbone weights are not copied and keep their names. The backward still runs through the frozen layers, but no gradients and no optimizer state are kept for them, and the projection heads are trained as before. The BatchNorm layers of the frozen ResNet stay in eval mode even during training, so they keep the pretrained running statistics: those are not saved with the adapters, and the model that is validated must be the same one that is reloaded from `best.pt`.
+
+`best.pt` then only holds the adapters and the projection heads (`lora_state_dict`), a few MB. `load_lora` loads such a file into a model: since the backbone is shared, many app-specific variants can be kept as small files and swapped into one model in memory.
+"""
+
+class LoRALinear(nn.Linear):
+    """
+    nn.Linear with a trainable low-rank update; made from an existing layer by
+    add_lora, which keeps its (frozen) weight and bias
+    """
+
+    def init_lora(self, rank, alpha):
+        factory = {"device": self.weight.device, "dtype": self.weight.dtype}
+        self.lora_A = nn.Parameter(torch.empty(rank, self.in_features, **factory))
+        self.lora_B = nn.Parameter(torch.zeros(self.out_features, rank, **factory))
+        nn.init.kaiming_uniform_(self.lora_A, a=5 ** 0.5)
+        self.lora_scale = alpha / rank
+
+    def forward(self, x):
+        return super().forward(x) + F.linear(F.linear(x, self.lora_A), self.lora_B) * self.lora_scale
+
+
+class LoRAConv2d(nn.Conv2d):
+    """
+    nn.Conv2d with a trainable low-rank update: a conv with the same kernel and
+    stride down to rank channels (A), then a 1x1 conv back up (B)
+    """
+
+    def init_lora(self, rank, alpha):
+        factory = {"device": self.weight.device, "dtype": self.weight.dtype}
+        self.lora_A = nn.Parameter(torch.empty(rank, self.in_channels, *self.kernel_size, **factory))
+        self.lora_B = nn.Parameter(torch.zeros(self.out_channels, rank, 1, 1, **factory))
+        nn.init.kaiming_uniform_(self.lora_A, a=5 ** 0.5)
+        self.lora_scale = alpha / rank
+
+    def forward(self, x):
+        down = F.conv2d(x, self.lora_A, None, self.stride, self.padding, self.dilation)
+        return super().forward(x) + F.conv2d(down, self.lora_B) * self.lora_scale
+
+
+def add_lora(model, rank=CFG.lora_rank, alpha=CFG.lora_alpha):
+    for encoder in (model.image_encoder, model.text_encoder):
+        for p in encoder.parameters():
+            p.requires_grad = False
+    # otherwise model.train() would let the ResNet's BatchNorm statistics drift away from
+    # the pretrained ones, which lora_state_dict does not save
+    model.frozen_batchnorm = True
+    model.train(model.training)
+    for name, module in model.text_encoder.named_modules():
+        if type(module) is nn.Linear and name.split(".")[-1] in CFG.lora_text_targets:
+            module.__class__ = LoRALinear
+            module.init_lora(rank, alpha)
+    for name, module in model.image_encoder.named_modules():
+        in_target = any(
+            f".{target}." in f".{name}." for target in CFG.lora_image_targets
+        )
+        # LoRAConv2d only handles plain (groups=1) convs with zero padding
+        if type(module) is nn.Conv2d and in_target and module.groups == 1 and module.padding_mode == "zeros":
+            module.__class__ = LoRAConv2d
+            module.init_lora(rank, alpha)
+    return model
+
+
+def lora_parameters(model):
+    return [p for name, p in model.named_parameters() if "lora_" in name]
+
+
+def lora_state_dict(model):
+    # the adapters and the projection heads; the frozen backbones come from the pretrained weights
+    return {
+        key: value for key, value in model.state_dict().items()
+        if "lora_" in key or key.startswith(("image_projection.", "text_projection."))
+    }
+
+
+def load_lora_state_dict(model, state):
+    if not lora_parameters(model):
+        add_lora(model)
+    missing, unexpected = model.load_state_dict(state, strict=False)
+    # the backbone weights are expected to be missing, the adapters and heads are not
+    trained_keys = lora_state_dict(model).keys()
+    missing = [key for key in missing if key in trained_keys]
+    if missing or unexpected:
+        raise RuntimeError(f"not a LoRA checkpoint of this model: missing {missing}, unexpected {unexpected}")
+    return model
+
+
+def load_lora(model, path):
+    return load_lora_state_dict(model, torch.load(path, map_location=CFG.device))
+
+
+def model_state_dict(model):
+    return lora_state_dict(model) if CFG.lora else model.state_dict()
+
+
+def load_model_state_dict(model, state):
+    if CFG.lora:
+        load_lora_state_dict(model, state)
+    else:
+        model.load_state_dict(state)
+
+"""Here's a handy function to train our model. There's not much happening here; just loading the batches, feeding them to the model and stepping the optimizer and lr_scheduler.
+
+One detail: calling `loss.item()` after every step makes the CPU wait until the GPU has finished that step, so the next batch cannot be queued in the meantime. The loss meters (`DeviceAvgMeter`) therefore add the losses up on the device and only copy the total to the host every `CFG.log_every` steps (that is also when the progress bar is updated) and at the end of the epoch."""
+
+def train_epoch(
+    model, train_loader, optimizer, lr_scheduler, step, scaler=None,
+    start_batch=0, loss_meter=None, on_checkpoint=None,
+):
+    # start_batch and loss_meter continue an epoch from a checkpoint; on_checkpoint(batch_idx, loss_meter)
+    # is called every CFG.checkpoint_every steps
+    if loss_meter is None:
+        loss_meter = DeviceAvgMeter()
+    tqdm_object = tqdm(
+        skip_batches(train_loader, start_batch), initial=start_batch, total=len(train_loader),
+        disable=not is_main_process(),
+    )
+    for batch_idx, batch in enumerate(tqdm_object, start=start_batch + 1):
         batch = {k: v.to(CFG.device) for k, v in batch.items() if k != "caption"}
-        loss = model(batch)
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        if CFG.grad_cache_sub_batch_size:
+            loss = grad_cache_step(model, batch, CFG.grad_cache_sub_batch_size, scaler)
+        else:
+            with amp_autocast():
+                loss = model(batch)
+            if scaler is not None:
+                scaler.scale(loss).backward()
+            else:
+                loss.backward()
+        if is_distributed():
+            all_reduce_gradients(model)
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
         if step == "batch":
             lr_scheduler.step()
 
-        count = batch["image"].size(0)
-        loss_meter.update(loss.item(), count)
+        count = len(next(iter(batch.values())))
+        loss_meter.update(loss, count)
 
-        tqdm_object.set_postfix(train_loss=loss_meter.avg, lr=get_lr(optimizer))
-    return loss_meter
+        if batch_idx % CFG.log_every == 0:
+            tqdm_object.set_postfix(train_loss=loss_meter.sync().avg, lr=get_lr(optimizer))
+        if on_checkpoint is not None and batch_idx % CFG.checkpoint_every == 0:
+            on_checkpoint(batch_idx, loss_meter.sync())
+    return loss_meter.sync()
 
 
 def valid_epoch(model, valid_loader):
-    loss_meter = AvgMeter()
+    loss_meter = DeviceAvgMeter()
 
-    tqdm_object = tqdm(valid_loader, total=len(valid_loader))
-    for batch in tqdm_object:
+    tqdm_object = tqdm(valid_loader, total=len(valid_loader), disable=not is_main_process())
+    for batch_idx, batch in enumerate(tqdm_object, start=1):
         batch = {k: v.to(CFG.device) for k, v in batch.items() if k != "caption"}
-        loss = model(batch)
+        with amp_autocast():
+            loss = model(batch)
 
-        count = batch["image"].size(0)
-        loss_meter.update(loss.item(), count)
+        count = len(next(iter(batch.values())))
+        loss_meter.update(loss, count)
 
-        tqdm_object.set_postfix(valid_loss=loss_meter.avg)
-    return loss_meter
+        if batch_idx % CFG.log_every == 0:
+            tqdm_object.set_postfix(valid_loss=loss_meter.sync().avg)
+    return loss_meter.sync()
 
 
 def main():
-    train_df, valid_df = make_train_valid_dfs()
+    if CFG.loss_targets == "identity" and (
+        not CFG.unique_batches or (CFG.cache_frozen_features and not CFG.trainable)
+    ):
+        # with repeated images in a batch, arange targets would push copies of a screenshot apart
+        raise ValueError('loss_targets = "identity" needs unique_batches (and the regular loaders)')
+    if CFG.lora and CFG.cache_frozen_features and not CFG.trainable:
+        # the cached features would go through the zero-initialized adapters once, and the
+        # adapters would never get a gradient: only the projection heads would train
+        raise ValueError("lora needs the regular loaders, not cache_frozen_features")
+    if CFG.shard_path is not None and CFG.unique_batches:
+        # the shards are streamed, there are no rows for UniqueKeyBatchSampler to arrange
+        raise ValueError("unique_batches needs the regular loaders, not shard_path")
+    with main_process_first():
+        train_df, valid_df = make_train_valid_dfs()
     tokenizer = DistilBertTokenizer.from_pretrained(CFG.text_tokenizer)
-    train_loader = build_loaders(train_df, tokenizer, mode="train")
-    valid_loader = build_loaders(valid_df, tokenizer, mode="valid")
-
-
     model = CLIPModel().to(CFG.device)
-    params = [
-        {"params": model.image_encoder.parameters(), "lr": CFG.image_encoder_lr},
-        {"params": model.text_encoder.parameters(), "lr": CFG.text_encoder_lr},
+    if CFG.lora:
+        add_lora(model)
+    if is_distributed():
+        broadcast_model(model)
+    with main_process_first():
+        if CFG.cache_frozen_features and not CFG.trainable:
+            train_loader = build_feature_loaders(model, train_df, tokenizer, mode="train")
+            valid_loader = build_feature_loaders(model, valid_df, tokenizer, mode="valid")
+        elif CFG.shard_path is not None:
+            train_loader = build_shard_loader(train_df, tokenizer, mode="train")
+            valid_loader = build_shard_loader(valid_df, tokenizer, mode="valid")
+        else:
+            train_loader = build_loaders(train_df, tokenizer, mode="train")
+            valid_loader = build_loaders(valid_df, tokenizer, mode="valid")
+    if CFG.compile:
+        compile_model(model)
+        if not (CFG.cache_frozen_features and not CFG.trainable):
+            warm_up_compiled(model)
+
+    if CFG.lora:
+        # the frozen backbones get no optimizer state at all
+        params = [{"params": lora_parameters(model), "lr": CFG.lora_lr}]
+    else:
+        params = [
+            {"params": model.image_encoder.parameters(), "lr": CFG.image_encoder_lr},
+            {"params": model.text_encoder.parameters(), "lr": CFG.text_encoder_lr},
+        ]
+    params.append(
         {"params": itertools.chain(
             model.image_projection.parameters(), model.text_projection.parameters()
         ), "lr": CFG.head_lr, "weight_decay": CFG.weight_decay}
-    ]
+    )
     optimizer = torch.optim.AdamW(params, weight_decay=0.)
     lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
         optimizer, mode="min", patience=CFG.patience, factor=CFG.factor
     )
     step = "epoch"
+    # bfloat16 has the range of float32, only float16 needs loss scaling
+    scaler = torch.amp.GradScaler("cuda") if CFG.amp and CFG.amp_dtype == torch.float16 else None
 
     best_loss = float('inf')
-    for epoch in range(CFG.epochs):
-        print(f"Epoch: {epoch + 1}")
+    start_epoch, start_batch, train_meter = 0, 0, None
+    checkpoint_file = f"{CFG.checkpoint_path}/last.pt" if CFG.checkpoint_path else None
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        start_epoch, start_batch, train_meter, best_loss = load_training_state(
+            checkpoint_file, model, optimizer, lr_scheduler, scaler
+        )
+        if is_main_process():
+            print(f"Resuming from epoch {start_epoch + 1}, batch {start_batch}")
+    writer = CheckpointWriter()
+
+    def save_checkpoint(epoch, batch_idx, loss_meter):
+        if checkpoint_file is not None and is_main_process():
+            writer.save(
+                training_state(
+                    model, optimizer, lr_scheduler, scaler, epoch, batch_idx, loss_meter, best_loss
+                ),
+                checkpoint_file,
+            )
+
+    for epoch in range(start_epoch, CFG.epochs):
+        if is_main_process():
+            print(f"Epoch: {epoch + 1}")
+        set_loader_epoch(train_loader, epoch)
         model.train()
-        train_loss = train_epoch(model, train_loader, optimizer, lr_scheduler, step)
+        train_loss = train_epoch(
+            model, train_loader, optimizer, lr_scheduler, step, scaler,
+            start_batch=start_batch, loss_meter=train_meter,
+            on_checkpoint=functools.partial(save_checkpoint, epoch),
+        )
+        start_batch, train_meter = 0, None
         model.eval()
         with torch.no_grad():
             valid_loss = valid_epoch(model, valid_loader)
+        if is_distributed():
+            all_reduce_meter(valid_loss)
 
         if valid_loss.avg < best_loss:
             best_loss = valid_loss.avg
-            torch.save(model.state_dict(), "best.pt")
-            print("Saved Best Model!")
+            if is_main_process():
+                writer.save(model_state_dict(model), "best.pt")
+                print("Saved Best Model!")
 
         lr_scheduler.step(valid_loss.avg)
+        save_checkpoint(epoch + 1, 0, AvgMeter())
+    writer.wait()
 
 """Running the next cell start training the model. Put the kernel on GPU mode. Every epoch should take about 8 minutes on GPU if you are using 8k version (even one epoch is enough!). It can take some seconds before training actually starts because we are going to encode all the captions once in the train and valid dataset, so please don't stop it! Every thing is working fine."""
 
 main()
 
+"""### Training on Several Processes
+
+`run_distributed` starts one training process: it joins the process group and calls `main()`. On one machine, `launch_distributed` forks `world_size` of them from the notebook and splits the CPU threads between them. Across nodes, export the notebook as a script that calls `run_distributed()` and start it with `torchrun --nnodes=... --nproc_per_node=... script.py`; the rank, world size and master address then come from the environment variables torchrun sets. Each process trains on `CFG.batch_size` samples per step, so the global batch (and the number of negatives) is `world_size * CFG.batch_size`.
+"""
+
+def run_distributed(rank=None, world_size=None):
+    if rank is None:
+        # started by torchrun: RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT are set
+        dist.init_process_group("gloo")
+    else:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        main()
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_distributed(world_size):
+    def worker(rank):
+        torch.set_num_threads(max(1, os.cpu_count() // world_size))
+        run_distributed(rank, world_size)
+
+    torch.multiprocessing.start_processes(worker, nprocs=world_size, start_method="fork")
+
+# launch_distributed(world_size=4)
+
 """## Inference
 
 Okay! We are done with training the model. Now, we need to do inference which in our case will be giving the model a piece of text and want it to retrieve the most relevant images from an unseen validation (or test) set.
 
 ### Getting Image Embeddings
 
-In this function, we are loading the model that we saved after training, feeding it images in validation set and returning the image_embeddings with shape (valid_set_size, 256) and the model itself.
+In this function, we are loading the model that we saved after training, feeding it images in validation set and returning the image_embeddings with shape (number_of_unique_images, 256) and the model itself.
+
+Every screenshot has about 5 captions, so the dataframe has about 5 rows per image. There is no point in running the image encoder 5 times on the same screen, so we first keep one row per image (`unique_images`). The returned embeddings are aligned with `valid_df["image"].unique()`, which is the list of file names you should pass to `find_matches`.
 """
 
 def get_image_embeddings(valid_df, model_path):
     tokenizer = DistilBertTokenizer.from_pretrained(CFG.text_tokenizer)
-    valid_loader = build_loaders(valid_df, tokenizer, mode="valid")
+    valid_loader = build_embedding_loader(unique_images(valid_df), tokenizer)
 
     model = CLIPModel().to(CFG.device)
-    model.load_state_dict(torch.load(model_path, map_location=CFG.device))
+    load_model_state_dict(model, torch.load(model_path, map_location=CFG.device))
     model.eval()
+    if CFG.compile:
+        compile_model(model)
 
     valid_image_embeddings = []
-    with torch.no_grad():
+    with torch.no_grad(), amp_autocast():
         for batch in tqdm(valid_loader):
             image_features = model.image_encoder(batch["image"].to(CFG.device))
             image_embeddings = model.image_projection(image_features)
-            valid_image_embeddings.append(image_embeddings)
+            valid_image_embeddings.append(image_embeddings.float())
     return model, torch.cat(valid_image_embeddings)
 
 _, valid_df = make_train_valid_dfs()
@@ -503,6 +2424,78 @@ model, image_embeddings = get_image_embeddings(valid_df, "best.pt")
 
 valid_df.head()
 
+"""### Mixed Precision vs. fp32
+
+`CFG.amp` runs the encoders under `torch.autocast` (bfloat16 by default, which also works on CPU) while the loss stays in float32. Before training with it, it is worth checking what it buys and what it costs: the cell below embeds the validation set twice, once in fp32 and once with autocast, and reports the throughput and the top-1 caption -> image retrieval accuracy of both.
+"""
+
+def encode_images(model, dataframe):
+    tokenizer = DistilBertTokenizer.from_pretrained(CFG.text_tokenizer)
+    loader = build_embedding_loader(unique_images(dataframe), tokenizer)
+    image_embeddings = []
+    with torch.no_grad(), amp_autocast():
+        for batch in loader:
+            image_features = model.image_encoder(batch["image"].to(CFG.device))
+            image_embeddings.append(model.image_projection(image_features).float())
+    return torch.cat(image_embeddings)
+
+
+def encode_captions(model, captions):
+    tokenizer = DistilBertTokenizer.from_pretrained(CFG.text_tokenizer)
+    text_embeddings = []
+    with torch.no_grad(), amp_autocast():
+        for start in range(0, len(captions), CFG.batch_size):
+            encoded_captions = tokenizer(
+                list(captions[start:start + CFG.batch_size]), padding=True, truncation=True,
+                max_length=CFG.max_length, return_tensors="pt",
+            )
+            text_features = model.text_encoder(
+                input_ids=encoded_captions["input_ids"].to(CFG.device),
+                attention_mask=encoded_captions["attention_mask"].to(CFG.device),
+            )
+            text_embeddings.append(model.text_projection(text_features).float())
+    return torch.cat(text_embeddings)
+
+
+def retrieval_accuracy(image_embeddings, text_embeddings, image_filenames, captions_images, chunk_size=1024):
+    # top-1 accuracy of retrieving the right screenshot for every caption
+    image_embeddings_n = F.normalize(image_embeddings, p=2, dim=-1)
+    text_embeddings_n = F.normalize(text_embeddings, p=2, dim=-1)
+    targets = torch.as_tensor(
+        pd.Index(image_filenames).get_indexer(captions_images), device=image_embeddings.device
+    )
+    correct = 0
+    for start in range(0, len(text_embeddings_n), chunk_size):
+        dot_similarity = text_embeddings_n[start:start + chunk_size] @ image_embeddings_n.T
+        correct += (dot_similarity.argmax(dim=-1) == targets[start:start + chunk_size]).sum().item()
+    return correct / len(text_embeddings_n)
+
+
+def compare_precision(model, dataframe):
+    model.eval()
+    use_amp = CFG.amp
+    results = {}
+    try:
+        for amp in (False, True):
+            CFG.amp = amp
+            start = time.perf_counter()
+            image_embeddings = encode_images(model, dataframe)
+            text_embeddings = encode_captions(model, dataframe["caption"].values)
+            elapsed = time.perf_counter() - start
+            accuracy = retrieval_accuracy(
+                image_embeddings, text_embeddings, dataframe["image"].unique(), dataframe["image"].values
+            )
+            name = str(CFG.amp_dtype).replace("torch.", "") if amp else "float32"
+            results[name] = {"samples/s": (len(image_embeddings) + len(text_embeddings)) / elapsed, "accuracy": accuracy}
+            print(f"{name}: {results[name]['samples/s']:.1f} samples/s, top-1 accuracy {accuracy:.4f}")
+    finally:
+        CFG.amp = use_amp
+    fp32, mixed = results.values()
+    print(f"speedup: {mixed['samples/s'] / fp32['samples/s']:.2f}x, accuracy change: {mixed['accuracy'] - fp32['accuracy']:+.4f}")
+    return results
+
+# compare_precision(model, valid_df)
+
 # save mode
 torch.save(model.state_dict(), '/content/drive/My Drive/Finalsimplemodel.pth')
 
@@ -528,13 +2521,12 @@ def find_matches(model, image_embeddings, query, image_filenames, n=9):
     text_embeddings_n = F.normalize(text_embeddings, p=2, dim=-1)
     dot_similarity = text_embeddings_n @ image_embeddings_n.T
 
-    values, indices = torch.topk(dot_similarity.squeeze(0), n * 5)
-    matches = [image_filenames[idx] for idx in indices[::5]]
+    values, indices = torch.topk(dot_similarity.squeeze(0), n)
+    matches = [image_filenames[idx] for idx in indices]
 
     _, axes = plt.subplots(3, 3, figsize=(10, 10))
     for match, ax in zip(matches, axes.flatten()):
-        image = cv2.imread(f"{CFG.image_path}/{match}")
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = load_image(match, backend="cv2")
         ax.imshow(image)
         ax.axis("off")
 
@@ -572,20 +2564,20 @@ print("Contents moved to /content/trainImages.")
 # test
 model_path="/content/drive/My Drive/Finalsimplemodel.pth"
 model = CLIPModel().to(CFG.device)
-model.load_state_dict(torch.load(model_path, map_location=CFG.device))
+load_model_state_dict(model, torch.load(model_path, map_location=CFG.device))
 model.eval()
 tokenizer = DistilBertTokenizer.from_pretrained(CFG.text_tokenizer)
 
 def get_image_embeddings_within_app(valid_df):
-    valid_loader = build_loaders(valid_df, tokenizer, mode="valid")
+    valid_loader = build_embedding_loader(unique_images(valid_df), tokenizer)
     valid_image_embeddings = []
-    with torch.no_grad():
+    with torch.no_grad(), amp_autocast():
         for batch in tqdm(valid_loader):
             image_features = model.image_encoder(batch["image"].to(CFG.device))
             #print(image_features)
             image_embeddings = model.image_projection(image_features)
             #print(image_embeddings)
-            valid_image_embeddings.append(image_embeddings)
+            valid_image_embeddings.append(image_embeddings.float())
             #print(valid_image_embeddings)
     return torch.cat(valid_image_embeddings)
 
@@ -629,7 +2621,7 @@ def find_matches_score_all(model, df, k=2,M=6):
         # Convert the set of unique image IDs back to a list
         image_ids = image_ids[:M]
         sampled_images_df = df[df['image'].isin(image_ids)]
-        image_filenames = sampled_images_df.values
+        image_filenames = sampled_images_df['image'].unique()
         print(' image file names is :',image_filenames)
         image_embeddings = get_image_embeddings_within_app(sampled_images_df)
 
@@ -654,11 +2646,11 @@ def find_matches_score_all(model, df, k=2,M=6):
             image_embeddings_n = F.normalize(image_embeddings, p=2, dim=-1)
             text_embeddings_n = F.normalize(text_embeddings, p=2, dim=-1)
             dot_similarity = text_embeddings_n @ image_embeddings_n.T
-            values, indices = torch.topk(dot_similarity.squeeze(0), k*5)
+            values, indices = torch.topk(dot_similarity.squeeze(0), min(k, len(image_filenames)))
             print(' value k is :',values)
-            matches = [image_filenames[idx] for idx in indices[::5]]
+            matches = [image_filenames[idx] for idx in indices]
             top_matches = matches  # Get the top k matches
-            predictions_k = matches[0]  # Predicted image names
+            predictions_k = matches[:1]  # Predicted image names
             print(' prediction k is :',predictions_k)
             prediction_list.append(predictions_k[0])  # Store the predicted image filename
             #prediction_list.append(predictions_k)  # Store the model predictions
@@ -688,10 +2680,10 @@ android_captions = df[df['activity_name']=='android']
 android_captions
 
 captions = df.groupby('image')['caption'].first().reset_index()
-image_filenames = selected_rows['image'].values
+image_filenames = selected_rows['image'].unique()
 find_matches_with_score(model, image_embeddings, captions, image_filenames, n=3)
 
-image_filenames=selected_rows['image'].values
+image_filenames=selected_rows['image'].unique()
 image_filenames
 
 def find_matches(model, image_embeddings, query, image_filenames, n=9):
@@ -711,13 +2703,12 @@ def find_matches(model, image_embeddings, query, image_filenames, n=9):
     text_embeddings_n = F.normalize(text_embeddings, p=2, dim=-1)
     dot_similarity = text_embeddings_n @ image_embeddings_n.T
 
-    values, indices = torch.topk(dot_similarity.squeeze(0), n * 5)
-    matches = [image_filenames[idx] for idx in indices[::5]]
+    values, indices = torch.topk(dot_similarity.squeeze(0), n)
+    matches = [image_filenames[idx] for idx in indices]
 
     _, axes = plt.subplots(3, 3, figsize=(10, 10))
     for match, ax in zip(matches, axes.flatten()):
-        image = cv2.imread(f"{CFG.image_path}/{match}")
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = load_image(match, backend="cv2")
         ax.imshow(image)
         ax.axis("off")
 
@@ -726,13 +2717,13 @@ def find_matches(model, image_embeddings, query, image_filenames, n=9):
 find_matches(model,
              image_embeddings,
              query="page showing you have not booked any trip in application",
-             image_filenames=selected_rows['image'].values,
+             image_filenames=selected_rows['image'].unique(),
              n=3)
 
 find_matches(model,
              image_embeddings,
              query="screen showing list of various countries for an app",
-             image_filenames=valid_df['image'].values,
+             image_filenames=valid_df['image'].unique(),
              n=9)
 
 valid_df['image'].values
@@ -746,19 +2737,19 @@ selected_rows.head()
 find_matches(model,
              image_embeddings,
              query="display of a footwear options in a shopping app",
-             image_filenames=valid_df['image'].values,
+             image_filenames=valid_df['image'].unique(),
              n=9)
 
 find_matches(model,
              image_embeddings,
              query="list of diet plans showing in application",
-             image_filenames=valid_df['image'].values,
+             image_filenames=valid_df['image'].unique(),
              n=9)
 
 find_matches(model,
              image_embeddings,
              query="pop up displaying introduction for the app",
-             image_filenames=valid_df['image'].values,
+             image_filenames=valid_df['image'].unique(),
              n=9)
 
 image_folder_path = '/content/drive/MyDrive/test'
@@ -769,9 +2760,9 @@ cv2_imshow(image)
 
 def get_image_embeddings(valid_df, model_path):
     tokenizer = DistilBertTokenizer.from_pretrained(CFG.text_tokenizer)
-    valid_loader = build_loaders(valid_df, tokenizer, mode="valid")
+    valid_loader = build_embedding_loader(unique_images(valid_df), tokenizer)
     model = CLIPModel().to(CFG.device)
-    model.load_state_dict(torch.load(model_path, map_location=CFG.device))
+    load_model_state_dict(model, torch.load(model_path, map_location=CFG.device))
     model.eval()
 
     valid_image_embeddings = []
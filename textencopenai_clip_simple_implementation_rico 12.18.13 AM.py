@@ -18,6 +18,7 @@ Given a query (raw text) like "pop-up message showing about free access	" or "a
 
 import os
 import cv2
+import time
 import gc
 import numpy as np
 import pandas as pd
@@ -27,6 +28,7 @@ import albumentations as A
 import matplotlib.pyplot as plt
 
 import torch
+import torch.utils.checkpoint
 from torch import nn
 import torch.nn.functional as F
 import timm
@@ -99,6 +101,10 @@ class CFG:
 
     pretrained = True # for both image encoder and text encoder
     trainable = True # for both image encoder and text encoder
+    # recompute the activations of the ResNet stages / MPNet layers in the backward
+    # instead of keeping them, see benchmark_grad_checkpointing
+    image_grad_checkpointing = False
+    text_grad_checkpointing = False
     temperature = 1.0
 
     # image size
@@ -193,7 +199,8 @@ class ImageEncoder(nn.Module):
     """
 
     def __init__(
-        self, model_name=CFG.model_name, pretrained=CFG.pretrained, trainable=CFG.trainable
+        self, model_name=CFG.model_name, pretrained=CFG.pretrained, trainable=CFG.trainable,
+        grad_checkpointing=CFG.image_grad_checkpointing,
     ):
         super().__init__()
         self.model = timm.create_model(
@@ -201,14 +208,39 @@ class ImageEncoder(nn.Module):
         )
         for p in self.model.parameters():
             p.requires_grad = trainable
+        self.set_grad_checkpointing(grad_checkpointing)
+
+    def set_grad_checkpointing(self, enable=True):
+        # checkpoints every stage (layer1 ... layer4 for a ResNet). Not timm's own
+        # set_grad_checkpointing: depending on the version it checkpoints reentrantly,
+        # which gives no gradients when the stage inputs do not require grad (frozen
+        # stages in front of LoRA adapters). The forwards are wrapped on the instance,
+        # so the parameter names stay the same.
+        stages = getattr(self.model, "stages", None)
+        if stages is None:
+            stages = [getattr(self.model, f"layer{i}") for i in range(1, 5) if hasattr(self.model, f"layer{i}")]
+        for stage in stages:
+            if enable:
+                stage.forward = checkpointed(type(stage).forward.__get__(stage))
+            else:
+                stage.__dict__.pop("forward", None)
 
     def forward(self, x):
         return self.model(x)
 
+
+def checkpointed(forward):
+    def checkpointed_forward(*args, **kwargs):
+        return torch.utils.checkpoint.checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return checkpointed_forward
+
 """## Text Encoder"""
 
 class TextEncoder(nn.Module):
-    def __init__(self, model_name=CFG.text_encoder_model, pretrained=CFG.pretrained, trainable=CFG.trainable):
+    def __init__(
+        self, model_name=CFG.text_encoder_model, pretrained=CFG.pretrained, trainable=CFG.trainable,
+        grad_checkpointing=CFG.text_grad_checkpointing,
+    ):
         super().__init__()
         if pretrained:
             self.tokenizer = AutoTokenizer.from_pretrained(model_name)
@@ -219,10 +251,20 @@ class TextEncoder(nn.Module):
 
         for p in self.model.parameters():
             p.requires_grad = trainable
+        self.set_grad_checkpointing(grad_checkpointing)
 
         # We are using the CLS token hidden representation as the sentence's embedding
         self.target_token_idx = 0
 
+    def set_grad_checkpointing(self, enable=True):
+        # MPNetPreTrainedModel does not support HuggingFace's gradient_checkpointing_enable,
+        # so the forward of every MPNet layer is wrapped like the image stages
+        for layer in self.model.encoder.layer:
+            if enable:
+                layer.forward = checkpointed(type(layer).forward.__get__(layer))
+            else:
+                layer.__dict__.pop("forward", None)
+
     def forward(self, input_ids, attention_mask):
         output = self.model(input_ids=input_ids, attention_mask=attention_mask)
         last_hidden_state = output.last_hidden_state
@@ -303,6 +345,69 @@ def cross_entropy(preds, targets, reduction='none'):
     elif reduction == "mean":
         return loss.mean()
 
+"""### Gradient Checkpointing
+
+MPNet is bigger than DistilBERT (12 layers instead of 6), and together with ResNet50 the activations that are kept for the backward pass are what limits the batch size. With `CFG.image_grad_checkpointing` / `CFG.text_grad_checkpointing` a tower only keeps the inputs of every ResNet stage / MPNet layer and recomputes the rest during the backward: much less memory, for roughly one extra forward pass of that tower. The parameter names do not change, so checkpoints load either way.
+
+`benchmark_grad_checkpointing` trains a few steps on a dummy batch with each combination and reports the time per step and the activation memory (the CUDA peak on a GPU; on CPU the bytes of the tensors autograd keeps for the backward).
+"""
+
+def benchmark_grad_checkpointing(batch_size=CFG.batch_size, length=64, steps=3):
+    model = CLIPModel().to(CFG.device)
+    model.train()
+    batch = {
+        "image": torch.zeros((batch_size, 3, CFG.size, CFG.size), device=CFG.device),
+        "input_ids": torch.zeros((batch_size, length), dtype=torch.long, device=CFG.device),
+        "attention_mask": torch.ones((batch_size, length), dtype=torch.long, device=CFG.device),
+    }
+    parameter_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def train_step():
+        saved = {}
+
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in parameter_storages:
+                saved[storage.data_ptr()] = storage.nbytes()
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            loss = model(batch)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        return sum(saved.values())
+
+    results = []
+    for image_checkpointing, text_checkpointing in itertools.product([False, True], repeat=2):
+        model.image_encoder.set_grad_checkpointing(image_checkpointing)
+        model.text_encoder.set_grad_checkpointing(text_checkpointing)
+        train_step() # warm-up
+        if CFG.device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            # weights and the batch are already allocated; the rest of the peak is the step
+            allocated = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        for _ in range(steps):
+            saved_bytes = train_step()
+        if CFG.device.type == "cuda":
+            torch.cuda.synchronize()
+            saved_bytes = torch.cuda.max_memory_allocated() - allocated
+        results.append({
+            "image_checkpointing": image_checkpointing,
+            "text_checkpointing": text_checkpointing,
+            "ms_per_step": (time.perf_counter() - start) / steps * 1000,
+            "activation_mb": saved_bytes / 2 ** 20,
+        })
+    results = pd.DataFrame(results)
+    baseline = results.iloc[0]
+    results["time_vs_baseline"] = results["ms_per_step"] / baseline["ms_per_step"]
+    results["memory_vs_baseline"] = results["activation_mb"] / baseline["activation_mb"]
+    print(results.to_string(index=False))
+    return results
+
+# benchmark_grad_checkpointing()
+
 """## Train"""
 
 def make_train_valid_dfs():
@@ -89,6 +89,14 @@ df.shape
 
 class CFG:
     margin = 1.0
+    # "fixed": the negimage column; "batch_hard" / "batch_all": the negatives are the
+    # other images of the batch, so negimage is never loaded
+    triplet_mining = "fixed"
+    # with "fixed": every mining_interval epochs, replace negimage with hard negatives
+    # found by the current model (0 = keep the negimage column of the csv)
+    mining_interval = 0
+    mining_exclude_same_app = False # also skip screenshots of the caption's own app
+    mining_top_k = 1 # pick the negative at random among the top_k closest screenshots
     debug = False
     image_path = image_path
     captions_path = captions_path
@@ -152,11 +160,14 @@ class CLIPDataset(torch.utils.data.Dataset):
         """
         image_filenames and cpations must have the same length; so, if there are
         multiple captions for each image, the image_filenames must have repetitive
-        file names
+        file names. negimage_filenames can be None when the negatives are mined
+        from the batch.
         """
 
         self.image_filenames = image_filenames
         self.negimage_filenames = negimage_filenames
+        # rows with the same image get the same id, so that batch mining skips them as negatives
+        self.image_ids = pd.factorize(image_filenames)[0]
         self.captions = list(captions)
         self.encoded_captions = tokenizer(
             list(captions), padding=True, truncation=True, max_length=CFG.max_length
@@ -173,11 +184,13 @@ class CLIPDataset(torch.utils.data.Dataset):
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         image = self.transforms(image=image)['image']
         item['image'] = torch.tensor(image).permute(2, 0, 1).float()
-        negimage = cv2.imread(f"{CFG.image_path}/{self.negimage_filenames[idx]}")
-        negimage = cv2.cvtColor(negimage, cv2.COLOR_BGR2RGB)
-        negimage = self.transforms(image=negimage)['image']
-        item['negimage'] = torch.tensor(negimage).permute(2, 0, 1).float()
+        if self.negimage_filenames is not None:
+            negimage = cv2.imread(f"{CFG.image_path}/{self.negimage_filenames[idx]}")
+            negimage = cv2.cvtColor(negimage, cv2.COLOR_BGR2RGB)
+            negimage = self.transforms(image=negimage)['image']
+            item['negimage'] = torch.tensor(negimage).permute(2, 0, 1).float()
         item['caption'] = self.captions[idx]
+        item['image_id'] = int(self.image_ids[idx])
 
         return item
 
@@ -274,6 +287,16 @@ class ProjectionHead(nn.Module):
 #### Check the cell below this code block for the continue of the explanations
 """
 
+"""### Mining the Negatives in the Batch
+
+With `CFG.triplet_mining = "fixed"`, every caption comes with the screenshot in its `negimage` column, so the image encoder runs on a second batch of images and the dataset decodes twice as many jpgs. But the batch already holds 31 other screenshots that can be used as negatives. With `"batch_hard"` or `"batch_all"`, `TripletLoss` computes the squared distance between every caption and every image of the batch in one matrix:
+
+- `batch_hard` takes, for every caption, the closest image that is not its own screenshot as the negative.
+- `batch_all` uses all the other images and averages the loss over the triplets that still break the margin (averaging over all of them would be dominated by the easy zeros).
+
+Rows of the same screenshot (Rico has about five captions per screen) are never negatives of each other: the dataset returns an `image_id` for every row and the loss masks the pairs with equal ids. The `negimage` column is not loaded at all in these modes.
+"""
+
 class TripletLoss(nn.Module):
     def __init__(self, margin=1.0):
         super(TripletLoss, self).__init__()
@@ -288,6 +311,27 @@ class TripletLoss(nn.Module):
         losses = torch.relu(distance_positive - distance_negative + self.margin)
         return losses.mean()
 
+    def calc_pairwise_euclidean(self, x1, x2):
+        # calc_euclidean for every row of x1 against every row of x2
+        distances = x1.pow(2).sum(1)[:, None] + x2.pow(2).sum(1)[None, :] - 2 * x1 @ x2.T
+        return distances.clamp(min=0)
+
+    def batch_hard(self, anchor: torch.Tensor, positive: torch.Tensor, image_ids: torch.Tensor) -> torch.Tensor:
+        distances = self.calc_pairwise_euclidean(anchor, positive)
+        distance_positive = distances.diagonal()
+        same_image = image_ids[:, None] == image_ids[None, :]
+        distance_negative = distances.masked_fill(same_image, float("inf")).min(dim=1).values
+        losses = torch.relu(distance_positive - distance_negative + self.margin)
+        return losses.mean()
+
+    def batch_all(self, anchor: torch.Tensor, positive: torch.Tensor, image_ids: torch.Tensor) -> torch.Tensor:
+        distances = self.calc_pairwise_euclidean(anchor, positive)
+        distance_positive = distances.diagonal()
+        same_image = image_ids[:, None] == image_ids[None, :]
+        losses = torch.relu(distance_positive[:, None] - distances + self.margin)
+        losses = losses.masked_fill(same_image, 0.0)
+        return losses.sum() / (losses > 0).sum().clamp(min=1)
+
 class CLIPModel(nn.Module):
     def __init__(
         self,
@@ -305,17 +349,21 @@ class CLIPModel(nn.Module):
     def forward(self, batch):
         # Getting Image and Text Features
         image_features = self.image_encoder(batch["image"])
-        negimage_features = self.image_encoder(batch["negimage"])
         text_features = self.text_encoder(
             input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]
         )
         # Getting Image and Text Embeddings (with same dimension)
         image_embeddings = self.image_projection(image_features)
-        negimage_embeddings = self.image_projection(negimage_features)
         text_embeddings = self.text_projection(text_features)
 
         # Calculate the Triplet Loss
         loss_fn = TripletLoss(margin=CFG.margin)
+        if CFG.triplet_mining == "batch_hard":
+            return loss_fn.batch_hard(text_embeddings, image_embeddings, batch["image_id"])
+        if CFG.triplet_mining == "batch_all":
+            return loss_fn.batch_all(text_embeddings, image_embeddings, batch["image_id"])
+        negimage_features = self.image_encoder(batch["negimage"])
+        negimage_embeddings = self.image_projection(negimage_features)
         loss = loss_fn(text_embeddings, image_embeddings, negimage_embeddings)  # Pass embeddings as arguments
 
         return loss
@@ -341,7 +389,7 @@ def build_loaders(dataframe, tokenizer, mode):
     dataset = CLIPDataset(
         dataframe["image"].values,
         dataframe["caption"].values,
-        dataframe["negimage"].values,
+        dataframe["negimage"].values if CFG.triplet_mining == "fixed" else None,
         tokenizer=tokenizer,
         transforms=transforms,
     )
@@ -353,6 +401,78 @@ def build_loaders(dataframe, tokenizer, mode):
     )
     return dataloader
 
+"""### Mining Hard Negatives
+
+The `negimage` column of the csv is fixed and mostly random, so after the first epoch most of those screenshots are already far from their captions and `torch.relu(... + margin)` is 0 for most triplets: the whole forward and backward pass of those rows teaches nothing. `mine_hard_negatives` embeds every screenshot and every caption with the current model and gives each caption the closest screenshot (in squared euclidean distance, like the loss) that is not its own as the new `negimage`. With `exclude_same_app=True`, screenshots of the caption's own app are skipped too, since those are often near duplicates. With `top_k > 1` the negative is drawn at random from the `top_k` closest screenshots, which is a bit softer than always taking the very closest one (a caption with fewer allowed screenshots than `top_k` only draws from those, and a caption with none left keeps the `negimage` of the csv). The distances are computed a chunk of captions at a time, so the full captions x screenshots matrix is never built. With `CFG.mining_interval` set, `main()` mines again every few epochs and rebuilds the train loader.
+"""
+
+def mine_hard_negatives(model, dataframe, tokenizer, exclude_same_app=False, top_k=1, chunk_size=1024):
+    images = dataframe.drop_duplicates("image").reset_index(drop=True)
+    image_dataset = CLIPDataset(
+        images["image"].values,
+        images["caption"].values,
+        None,
+        tokenizer=tokenizer,
+        transforms=get_transforms(mode="valid"),
+    )
+    image_loader = torch.utils.data.DataLoader(
+        image_dataset, batch_size=CFG.batch_size, num_workers=CFG.num_workers
+    )
+    captions = dataframe["caption"].astype(str).tolist()
+
+    model.eval()
+    image_embeddings, text_embeddings = [], []
+    with torch.no_grad():
+        for batch in tqdm(image_loader):
+            image_features = model.image_encoder(batch["image"].to(CFG.device))
+            image_embeddings.append(model.image_projection(image_features))
+        for start in tqdm(range(0, len(captions), CFG.batch_size)):
+            encoded_captions = tokenizer(
+                captions[start:start + CFG.batch_size], padding=True, truncation=True,
+                max_length=CFG.max_length, return_tensors="pt",
+            )
+            text_features = model.text_encoder(
+                input_ids=encoded_captions["input_ids"].to(CFG.device),
+                attention_mask=encoded_captions["attention_mask"].to(CFG.device),
+            )
+            text_embeddings.append(model.text_projection(text_features))
+    image_embeddings = torch.cat(image_embeddings)
+    text_embeddings = torch.cat(text_embeddings)
+
+    # for every caption, the row of its own screenshot in images
+    positive_rows = torch.as_tensor(
+        pd.Index(images["image"]).get_indexer(dataframe["image"]), device=CFG.device
+    )
+    if exclude_same_app:
+        app_ids, _ = pd.factorize(pd.concat([images["activity_name"], dataframe["activity_name"]]))
+        image_apps = torch.as_tensor(app_ids[:len(images)], device=CFG.device)
+        caption_apps = torch.as_tensor(app_ids[len(images):], device=CFG.device)
+
+    loss_fn = TripletLoss(margin=CFG.margin)
+    negative_rows = []
+    with torch.no_grad():
+        for start in range(0, len(text_embeddings), chunk_size):
+            end = start + chunk_size
+            distances = loss_fn.calc_pairwise_euclidean(text_embeddings[start:end], image_embeddings)
+            rows = torch.arange(len(distances), device=CFG.device)
+            distances[rows, positive_rows[start:end]] = float("inf")
+            if exclude_same_app:
+                same_app = caption_apps[start:end, None] == image_apps[None, :]
+                distances.masked_fill_(same_app, float("inf"))
+            nearest = distances.topk(min(top_k, len(images)), dim=1, largest=False).indices
+            # the masked (inf) columns sort last; only draw among the finite ones of each row
+            n_candidates = torch.isfinite(distances).sum(1).clamp(max=nearest.size(1))
+            pick = (torch.rand(len(nearest), device=CFG.device) * n_candidates.clamp(min=1)).long()
+            picked = nearest.gather(1, pick[:, None]).squeeze(1)
+            negative_rows.append(torch.where(n_candidates > 0, picked, -1))
+    negative_rows = torch.cat(negative_rows).cpu().numpy()
+
+    dataframe = dataframe.copy()
+    # a caption without any allowed screenshot keeps its negimage from the csv
+    mined = negative_rows >= 0
+    dataframe.loc[mined, "negimage"] = images["image"].values[negative_rows[mined]]
+    return dataframe
+
 def train_epoch(model, train_loader, optimizer, lr_scheduler, step):
     loss_meter = AvgMeter()
     tqdm_object = tqdm(train_loader, total=len(train_loader))
@@ -411,6 +531,12 @@ def main():
     best_loss = float('inf')
     for epoch in range(CFG.epochs):
         print(f"Epoch: {epoch + 1}")
+        if CFG.mining_interval and epoch > 0 and epoch % CFG.mining_interval == 0:
+            train_df = mine_hard_negatives(
+                model, train_df, tokenizer,
+                exclude_same_app=CFG.mining_exclude_same_app, top_k=CFG.mining_top_k,
+            )
+            train_loader = build_loaders(train_df, tokenizer, mode="train")
         model.train()
         train_loss = train_epoch(model, train_loader, optimizer, lr_scheduler, step)
         model.eval()